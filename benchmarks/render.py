@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+""" Benchmark of the rendering of feed entries into messages. Entries
+made of the documents of the corpus directory are rendered serially with
+renderMessage, then through a YRenderer with each given number of
+processes, and the speedup over serial rendering is reported. Like the
+agent, this needs a config.py file next to main.py.
+
+    python3 benchmarks/render.py [--entries N] [--workers 1,2,4]
+
+The pool of processes is started before it is timed, and render caches
+are left out, so that only rendering itself is measured. """
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import main as yarss2imap
+from run import documents
+
+
+def jobs(count, run):
+    """ Returns count (feed title, encoding, entry fields) jobs made of
+    the corpus documents. Jobs of different runs have different render
+    keys. """
+
+    corpus = [html for name, html in documents()]
+    result = []
+    for index in range(count):
+        link = 'http://example.org/' + str(run) + '/' + str(index)
+        fields = {'title': 'Entry ' + str(index),
+                  'author': 'Someone',
+                  'link': link,
+                  'messageId': '<' + str(run) + '.' + str(index) + \
+                               '@' + yarss2imap.MESSAGE_ID_DOMAIN + '>',
+                  'date': tuple(time.gmtime(1600000000 + index * 3600)),
+                  'content': corpus[index % len(corpus)]}
+        result.append(('Benchmark feed', 'utf-8', fields))
+    return result
+
+
+def serial(entries):
+    """ Returns the time taken to render entries one after the other. """
+
+    started = time.perf_counter()
+    for job in jobs(entries, 'serial'):
+        yarss2imap.renderMessage(*job)
+    return time.perf_counter() - started
+
+
+def pooled(entries, workers):
+    """ Returns the time taken to render entries with a YRenderer using
+    given number of processes. """
+
+    renderer = yarss2imap.YRenderer(store=None, workers=workers,
+                                    memorySize=0)
+    try:
+        # Start the processes before timing
+        list(renderer.render(jobs(workers * 2, 'warmup' + str(workers))))
+        started = time.perf_counter()
+        for message in renderer.render(jobs(entries, workers)):
+            pass
+        return time.perf_counter() - started
+    finally:
+        renderer.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark the rendering of feed entries.')
+    parser.add_argument('--entries', type=int, default=200,
+                        help='entries rendered in each run (default 200)')
+    parser.add_argument('--workers', default='1,2,4,' + str(os.cpu_count()),
+                        help='comma separated numbers of processes '
+                             '(default 1,2,4 and the number of cores)')
+    args = parser.parse_args()
+    workerCounts = sorted(set(int(count)
+                              for count in args.workers.split(',')))
+
+    print(str(os.cpu_count()) + ' cores, ' + str(args.entries) + ' entries')
+    row = '%-10s %9s %11s %8s'
+    print(row % ('workers', 'seconds', 'entries/s', 'speedup'))
+    reference = serial(args.entries)
+    print(row % ('serial', '%.2f' % reference,
+                 '%.0f' % (args.entries / reference), '1.00'))
+    for workers in workerCounts:
+        elapsed = pooled(args.entries, workers)
+        print(row % (workers, '%.2f' % elapsed,
+                     '%.0f' % (args.entries / elapsed),
+                     '%.2f' % (reference / elapsed)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
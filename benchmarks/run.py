@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+""" Benchmark of html2text on the feed contents found in the corpus
+directory. For each document, reports its conversion throughput, the
+percentiles of its conversion time and the peak memory used to convert
+it. Then checks that each conversion gives the text expected in the
+expected directory, so that html2text can be optimized safely.
+
+    python3 benchmarks/run.py [--repeat N] [--update] [document ...]
+
+With --update, expected texts are written instead of being checked.
+Exits with status 1 when a conversion differs from the expected text. """
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import html2text
+
+CORPUS = os.path.join(HERE, 'corpus')
+EXPECTED = os.path.join(HERE, 'expected')
+
+
+def percentile(values, percent):
+    """ Returns the given percentile of values (nearest rank). """
+
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def documents(names=None):
+    """ Returns the (name, HTML) pairs of the corpus, sorted by name. """
+
+    if not names:
+        names = sorted(name[:-len('.html')] for name in os.listdir(CORPUS)
+                       if name.endswith('.html'))
+    result = []
+    for name in names:
+        with open(os.path.join(CORPUS, name + '.html'),
+                  encoding='utf-8') as f:
+            result.append((name, f.read()))
+    return result
+
+
+def measure(html, repeat):
+    """ Returns the conversion times of a document, its peak memory
+    and the converted text. """
+
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        text = html2text.html2text(html)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    html2text.html2text(html)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak, text
+
+
+def check(name, text, update):
+    """ Compares a converted text with the expected one, or writes it.
+    Returns whether they are equal. """
+
+    path = os.path.join(EXPECTED, name + '.txt')
+    if update:
+        os.makedirs(EXPECTED, exist_ok=True)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        return True
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding='utf-8', newline='') as f:
+        return f.read() == text
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark html2text on the feed corpus.')
+    parser.add_argument('names', nargs='*', metavar='document',
+                        help='corpus documents to use, without .html '
+                             '(all of them by default)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='conversions of each document (default 10)')
+    parser.add_argument('--update', action='store_true',
+                        help='write expected texts instead of checking them')
+    args = parser.parse_args()
+
+    row = '%-22s %8s %9s %8s %8s %8s %9s  %s'
+    print(row % ('document', 'KB', 'KB/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                 'peak KB', 'output'))
+    allTimes = []
+    totalKB = 0.0
+    totalTime = 0.0
+    failures = 0
+    for name, html in documents(args.names):
+        kb = len(html.encode('utf-8')) / 1024.0
+        times, peak, text = measure(html, args.repeat)
+        same = check(name, text, args.update)
+        if not same:
+            failures += 1
+        allTimes += times
+        totalKB += kb * len(times)
+        totalTime += sum(times)
+        print(row % (name, '%.1f' % kb,
+                     '%.0f' % (kb * len(times) / sum(times)),
+                     '%.2f' % (percentile(times, 50) * 1000),
+                     '%.2f' % (percentile(times, 90) * 1000),
+                     '%.2f' % (percentile(times, 99) * 1000),
+                     '%.0f' % (peak / 1024.0),
+                     'written' if args.update else
+                     'same' if same else 'DIFFERENT'))
+    if allTimes:
+        print(row % ('all', '%.1f' % (totalKB / args.repeat),
+                     '%.0f' % (totalKB / totalTime),
+                     '%.2f' % (percentile(allTimes, 50) * 1000),
+                     '%.2f' % (percentile(allTimes, 90) * 1000),
+                     '%.2f' % (percentile(allTimes, 99) * 1000),
+                     '', ''))
+    if failures:
+        print(str(failures) + ' documents are not converted as expected.')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -30,7 +30,7 @@ try: #Python3
     import urllib.request as urllib
 except:
     import urllib
-import optparse, re, sys, codecs, types
+import optparse, re, sys, codecs, types, collections
 
 try: from textwrap import wrap
 except: pass
@@ -83,23 +83,27 @@ unifiable_n = {}
 for k in unifiable.keys():
     unifiable_n[name2cp(k)] = unifiable[k]
 
-def charref(name):
+def charref(name, unicode_snob=None, table=None):
+    if unicode_snob is None: unicode_snob = UNICODE_SNOB
+    if table is None: table = unifiable_n
     if name[0] in ['x','X']:
         c = int(name[1:], 16)
     else:
         c = int(name)
     
-    if not UNICODE_SNOB and c in unifiable_n.keys():
-        return unifiable_n[c]
+    if not unicode_snob and c in table:
+        return table[c]
     else:
         try:
             return unichr(c)
         except NameError: #Python3
             return chr(c)
 
-def entityref(c):
-    if not UNICODE_SNOB and c in unifiable.keys():
-        return unifiable[c]
+def entityref(c, unicode_snob=None, table=None):
+    if unicode_snob is None: unicode_snob = UNICODE_SNOB
+    if table is None: table = unifiable
+    if not unicode_snob and c in table:
+        return table[c]
     else:
         try: name2cp(c)
         except KeyError: return "&" + c + ';'
@@ -116,6 +120,7 @@ def replaceEntities(s):
     else: return entityref(s)
 
 r_unescape = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
+r_whitespace = re.compile(r"\s+")
 def unescape(s):
     return r_unescape.sub(replaceEntities, s)
 
@@ -124,34 +129,39 @@ def unescape(s):
 def onlywhite(line):
     """Return true if the line does only consist of whitespace characters."""
     for c in line:
-        if c is not ' ' and c is not '  ':
-            return c is ' '
+        if c != ' ' and c != '  ':
+            return c == ' '
     return line
 
-def optwrap(text):
-    """Wrap all paragraphs in the provided text."""
-    if not BODY_WIDTH:
-        return text
-    
-    assert wrap, "Requires Python 2.3."
-    result = ''
+def wrapped_lines(text, width):
+    """Yield the lines of the provided text, with its paragraphs wrapped."""
     newlines = 0
     for para in text.split("\n"):
         if len(para) > 0:
             if para[0] != ' ' and para[0] != '-' and para[0] != '*':
-                for line in wrap(para, BODY_WIDTH):
-                    result += line + "\n"
-                result += "\n"
+                for line in wrap(para, width):
+                    yield line
+                yield ""
                 newlines = 2
             else:
                 if not onlywhite(para):
-                    result += para + "\n"
+                    yield para
                     newlines = 1
         else:
             if newlines < 2:
-                result += "\n"
+                yield ""
                 newlines += 1
-    return result
+
+def optwrap(text, width=None):
+    """Wrap all paragraphs in the provided text."""
+    if width is None: width = BODY_WIDTH
+    if not width:
+        return text
+    
+    assert wrap, "Requires Python 2.3."
+    lines = list(wrapped_lines(text, width))
+    lines.append('')
+    return "\n".join(lines)
 
 def hn(tag):
     if tag[0] == 'h' and len(tag) == 2:
@@ -198,11 +208,12 @@ def google_list_style(style):
             return 'ul'
     return 'ol'
 
-def google_nest_count(style):
+def google_nest_count(style, indent=None):
     """calculate the nesting count of google doc lists"""
+    if indent is None: indent = GOOGLE_LIST_INDENT
     nest_count = 0
     if 'margin-left' in style:
-        nest_count = int(style['margin-left'][:-2]) / GOOGLE_LIST_INDENT
+        nest_count = int(style['margin-left'][:-2]) / indent
     return nest_count
 
 def google_has_height(style):
@@ -238,10 +249,68 @@ def list_numbering_start(attrs):
     else:
         return 0
 
+Options = collections.namedtuple('Options', [
+    'unicode_snob', 'links_each_paragraph', 'body_width',
+    'skip_internal_links', 'inline_links', 'google_list_indent',
+    'ignore_anchors', 'ignore_images', 'google_doc', 'ul_item_mark',
+    'hide_strikethrough'])
+
+def default_options():
+    """Return the options given by the module settings."""
+    return Options(unicode_snob=UNICODE_SNOB,
+                   links_each_paragraph=LINKS_EACH_PARAGRAPH,
+                   body_width=BODY_WIDTH,
+                   skip_internal_links=SKIP_INTERNAL_LINKS,
+                   inline_links=INLINE_LINKS,
+                   google_list_indent=GOOGLE_LIST_INDENT,
+                   ignore_anchors=IGNORE_ANCHORS,
+                   ignore_images=IGNORE_IMAGES,
+                   google_doc=options.google_doc,
+                   ul_item_mark=options.ul_item_mark,
+                   hide_strikethrough=getattr(options, 'hide_strikethrough',
+                                              False))
+
+class HTML2Text(object):
+    """Converter from HTML to text with fixed options. It keeps no state
+    between documents, so that one converter can be reused, and shared
+    between threads."""
+    def __init__(self, options=None, baseurl=''):
+        if options is None: options = default_options()
+        self.options = options
+        self.baseurl = baseurl
+
+        # Entity tables of this converter
+        self.unifiable = dict(unifiable)
+        self.unifiable_n = dict(unifiable_n)
+        if options.google_doc:
+            del self.unifiable_n[name2cp('nbsp')]
+            self.unifiable['nbsp'] = '&nbsp_place_holder;'
+
+    def charref(self, name):
+        return charref(name, self.options.unicode_snob, self.unifiable_n)
+
+    def entityref(self, c):
+        return entityref(c, self.options.unicode_snob, self.unifiable)
+
+    def parser(self, out=None, baseurl=None):
+        """Return a new parser for one document."""
+        if baseurl is None: baseurl = self.baseurl
+        return _html2text(out, baseurl, self)
+
+    def handle(self, html, baseurl=None):
+        """Return the text version of one HTML document."""
+        h = self.parser(None, baseurl)
+        h.feed(html)
+        h.feed("")
+        return optwrap(h.close(), self.options.body_width)
+
 class _html2text(HTMLParser.HTMLParser):
-    def __init__(self, out=None, baseurl=''):
+    def __init__(self, out=None, baseurl='', converter=None):
         HTMLParser.HTMLParser.__init__(self)
         
+        if converter is None: converter = HTML2Text(baseurl=baseurl)
+        self.converter = converter
+        self.options = converter.options
         if out is None: self.out = self.outtextf
         else: self.out = out
         self.outtextlist = [] # empty list to store output characters before they are  "joined"
@@ -275,10 +344,6 @@ class _html2text(HTMLParser.HTMLParser):
         self.abbr_data = None # last inner HTML (for abbr being defined)
         self.abbr_list = {} # stack of abbreviations to write later
         self.baseurl = baseurl
-
-        if options.google_doc:
-            del unifiable_n[name2cp('nbsp')]
-            unifiable['nbsp'] = '&nbsp_place_holder;'
     
     def feed(self, data):
         data = data.replace("</' + 'script>", "</ignore>")
@@ -296,16 +361,16 @@ class _html2text(HTMLParser.HTMLParser):
 
         self.outtext = self.outtext.join(self.outtextlist)
         
-        if options.google_doc:
+        if self.options.google_doc:
             self.outtext = self.outtext.replace('&nbsp_place_holder;', ' ');
         
         return self.outtext
         
     def handle_charref(self, c):
-        self.o(charref(c), 1)
+        self.o(self.converter.charref(c), 1)
 
     def handle_entityref(self, c):
-        self.o(entityref(c), 1)
+        self.o(self.converter.entityref(c), 1)
             
     def handle_starttag(self, tag, attrs):
         self.handle_tag(tag, attrs, 1)
@@ -346,7 +411,7 @@ class _html2text(HTMLParser.HTMLParser):
         parent_emphasis = google_text_emphasis(parent_style)
 
         # handle Google's text emphasis
-        strikethrough =  'line-through' in tag_emphasis and options.hide_strikethrough
+        strikethrough =  'line-through' in tag_emphasis and self.options.hide_strikethrough
         bold = 'bold' in tag_emphasis and not 'bold' in parent_emphasis
         italic = 'italic' in tag_emphasis and not 'italic' in parent_emphasis
         fixed = google_fixed_width_font(tag_style) and not \
@@ -410,7 +475,7 @@ class _html2text(HTMLParser.HTMLParser):
         else:
             attrs = dict(attrs)
 
-        if options.google_doc:
+        if self.options.google_doc:
             # the attrs parameter is empty for a closing tag. in addition, we
             # need the attributes of the parent nodes in order to get a
             # complete style description for the current element. we assume
@@ -436,7 +501,7 @@ class _html2text(HTMLParser.HTMLParser):
                 return # prevent redundant emphasis marks on headers
 
         if tag in ['p', 'div']:
-            if options.google_doc:
+            if self.options.google_doc:
                 if start and google_has_height(tag_style):
                     self.p()
                 else:
@@ -478,7 +543,7 @@ class _html2text(HTMLParser.HTMLParser):
             else:
                 self.o("</"+tag+">")
 
-        if options.google_doc:
+        if self.options.google_doc:
             if not self.inheader:
                 # handle some font attributes, but leave headers clean
                 self.handle_emphasis(start, tag_style, parent_style)
@@ -496,9 +561,9 @@ class _html2text(HTMLParser.HTMLParser):
                     self.abbr_title = None
                 self.abbr_data = ''
         
-        if tag == "a" and not IGNORE_ANCHORS:
+        if tag == "a" and not self.options.ignore_anchors:
             if start:
-                if has_key(attrs, 'href') and not (SKIP_INTERNAL_LINKS and attrs['href'].startswith('#')): 
+                if has_key(attrs, 'href') and not (self.options.skip_internal_links and attrs['href'].startswith('#')): 
                     self.astack.append(attrs)
                     self.o("[")
                 else:
@@ -507,7 +572,7 @@ class _html2text(HTMLParser.HTMLParser):
                 if self.astack:
                     a = self.astack.pop()
                     if a:
-                        if INLINE_LINKS:
+                        if self.options.inline_links:
                             self.o("](" + a['href'] + ")")
                         else:
                             i = self.previousIndex(a)
@@ -520,11 +585,11 @@ class _html2text(HTMLParser.HTMLParser):
                                 self.a.append(a)
                             self.o("][" + str(a['count']) + "]")
         
-        if tag == "img" and start and not IGNORE_IMAGES:
+        if tag == "img" and start and not self.options.ignore_images:
             if has_key(attrs, 'src'):
                 attrs['href'] = attrs['src']
                 alt = attrs.get('alt', '')
-                if INLINE_LINKS:
+                if self.options.inline_links:
                     self.o("![")
                     self.o(alt)
                     self.o("]("+ attrs['href'] +")")
@@ -551,7 +616,7 @@ class _html2text(HTMLParser.HTMLParser):
             if (not self.list) and (not self.lastWasList):
                 self.p()
             if start:
-                if options.google_doc:
+                if self.options.google_doc:
                     list_style = google_list_style(tag_style)
                 else:
                     list_style = tag
@@ -568,12 +633,13 @@ class _html2text(HTMLParser.HTMLParser):
             if start:
                 if self.list: li = self.list[-1]
                 else: li = {'name':'ul', 'num':0}
-                if options.google_doc:
-                    nest_count = google_nest_count(tag_style)
+                if self.options.google_doc:
+                    nest_count = google_nest_count(tag_style,
+                        self.options.google_list_indent)
                 else:
                     nest_count = len(self.list)
                 self.o("  " * nest_count) #TODO: line up <ol><li>s > 9 correctly.
-                if li['name'] == "ul": self.o(options.ul_item_mark + " ")
+                if li['name'] == "ul": self.o(self.options.ul_item_mark + " ")
                 elif li['name'] == "ol":
                     li['num'] += 1
                     self.o(str(li['num'])+". ")
@@ -603,7 +669,7 @@ class _html2text(HTMLParser.HTMLParser):
         if self.abbr_data is not None: self.abbr_data += data
         
         if not self.quiet: 
-            if options.google_doc:
+            if self.options.google_doc:
                 # prevent white space immediately after 'begin emphasis' marks ('**' and '_')
                 lstripped_data = data.lstrip()
                 if self.drop_white_space and not (self.pre or self.code):
@@ -612,7 +678,7 @@ class _html2text(HTMLParser.HTMLParser):
                     self.drop_white_space = 0
             
             if puredata and not self.pre:
-                data = re.sub('\s+', ' ', data)
+                data = r_whitespace.sub(' ', data)
                 if data and data[0] == ' ':
                     self.space = 1
                     data = data[1:]
@@ -649,7 +715,7 @@ class _html2text(HTMLParser.HTMLParser):
                 if not self.lastWasNL: self.out(' ')
                 self.space = 0
 
-            if self.a and ((self.p_p == 2 and LINKS_EACH_PARAGRAPH) or force == "end"):
+            if self.a and ((self.p_p == 2 and self.options.links_each_paragraph) or force == "end"):
                 if force == "end": self.out("\n")
 
                 newa = []
@@ -690,14 +756,14 @@ def wrapwrite(text):
     except AttributeError:
         sys.stdout.write(text)
 
-def html2text_file(html, out=wrapwrite, baseurl=''):
-    h = _html2text(out, baseurl)
+def html2text_file(html, out=wrapwrite, baseurl='', options=None):
+    h = HTML2Text(options, baseurl).parser(out)
     h.feed(html)
     h.feed("")
     return h.close()
 
-def html2text(html, baseurl=''):
-    return optwrap(html2text_file(html, None, baseurl))
+def html2text(html, baseurl='', options=None):
+    return HTML2Text(options, baseurl).handle(html)
 
 class Storage: pass
 options = Storage()
@@ -719,16 +785,20 @@ if __name__ == "__main__":
         default=GOOGLE_LIST_INDENT, help="number of pixels Google indents nested lists")
     p.add_option("-s", "--hide-strikethrough", action="store_true", dest="hide_strikethrough",
         default=False, help="hide strike-through text. only relevent when -g is specified as well")
-    (options, args) = p.parse_args()
+    (cli_options, args) = p.parse_args()
 
     # handle options
-    if options.ul_style_dash:
-        options.ul_item_mark = '-'
+    if cli_options.ul_style_dash:
+        ul_item_mark = '-'
     else:
-        options.ul_item_mark = '*'
+        ul_item_mark = '*'
 
-    BODY_WIDTH = options.body_width
-    GOOGLE_LIST_INDENT = options.list_indent
+    converter_options = default_options()._replace(
+        google_doc=cli_options.google_doc,
+        ul_item_mark=ul_item_mark,
+        body_width=cli_options.body_width,
+        google_list_indent=cli_options.list_indent,
+        hide_strikethrough=cli_options.hide_strikethrough)
 
     # process input
     if len(args) > 0:
@@ -764,4 +834,4 @@ if __name__ == "__main__":
             data = data.decode(encoding)
     else:
         data = sys.stdin.read()
-    wrapwrite(html2text(data, baseurl))
+    wrapwrite(html2text(data, baseurl, converter_options))
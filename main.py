@@ -4,22 +4,103 @@ import email, email.message, email.header, email.utils
 import email.mime.multipart, email.mime.text
 import re
 import feedparser
-import urllib.parse
+import urllib.parse, urllib.request
 import time, datetime
 import sys
 import html2text
 import unicodedata
 import logging
+import sqlite3
+import threading
+import contextlib
+import concurrent.futures, concurrent.futures.process
+import multiprocessing
+import hashlib, json, collections
+import os
+import select
+import ssl
+import heapq, calendar, statistics
 logging.basicConfig(
         filename=config.logfile,
         format='%(levelname)s:%(asctime)s %(message)s',
         level=logging.DEBUG)
 from xml.etree import ElementTree
 import imap_utf7
-from io import BytesIO
+from io import BytesIO, StringIO
 from email.generator import BytesGenerator
 
 
+# Number of feeds downloaded and parsed at the same time
+FETCH_WORKERS = getattr(config, 'fetchWorkers', 16)
+
+# Maximum number of simultaneous downloads from a single host
+FETCH_PER_HOST = getattr(config, 'fetchPerHost', 2)
+
+# Number of seconds a feed server may take to answer before its
+# download is given up
+FETCH_TIMEOUT = getattr(config, 'fetchTimeout', 30)
+
+# Number of IMAP connections used to update feed mailboxes in parallel
+IMAP_CONNECTIONS = getattr(config, 'imapConnections', 4)
+
+# Number of seconds after which a pooled IMAP connection is renewed
+IMAP_CONNECTION_LIFETIME = getattr(config, 'imapConnectionLifetime', 3600)
+
+# Whether new command messages are noticed as soon as they reach the INBOX
+IDLE_WATCH = getattr(config, 'idleWatch', True)
+
+# Number of seconds after which IDLE is restarted (RFC 2177)
+IDLE_REFRESH = 29 * 60
+
+# Number of seconds after which every mailbox is searched for commands,
+# even if its status did not change
+COMMAND_RESCAN_INTERVAL = getattr(config, 'commandRescanInterval', 3600)
+
+# Maximum number of messages sent in one MULTIAPPEND or one pipeline
+APPEND_BATCH = getattr(config, 'appendBatch', 50)
+
+# Maximum number of STATUS commands sent at once
+STATUS_BATCH = 100
+
+# Maximum number of CREATE and SUBSCRIBE commands sent at once
+MAILBOX_BATCH = 100
+
+# SQLite database where the agent keeps its state between runs
+STATE_FILE = getattr(config, 'stateFile', 'yarss2imap.sqlite')
+
+# Number of processes rendering feed entries into messages,
+# 1 to render them in the main process
+RENDER_WORKERS = getattr(config, 'renderWorkers', os.cpu_count() or 1)
+
+# Number of rendered messages kept on disk, and in memory, so that
+# entries seen again are not rendered again
+RENDER_CACHE_SIZE = getattr(config, 'renderCacheSize', 2000)
+RENDER_MEMORY_CACHE_SIZE = 200
+
+# Converter of entry contents into text, shared by rendering threads
+HTML_CONVERTER = html2text.HTML2Text()
+
+# To be increased whenever renderMessage renders entries differently,
+# so that messages rendered before are not used anymore
+RENDER_VERSION = 2
+
+# Number of seconds after which all entries of a feed are checked again,
+# and not only the ones newer than the newest entry delivered before
+FULL_UPDATE_INTERVAL = getattr(config, 'fullUpdateInterval', 86400)
+
+# Domain of the Message-ID given to messages about feed entries, which
+# tells them apart from Message-IDs added by servers
+MESSAGE_ID_DOMAIN = 'yarss2imap'
+
+# Minimum and maximum number of seconds between two downloads of a feed
+MIN_POLL_INTERVAL = getattr(config, 'minPollInterval', 300)
+MAX_POLL_INTERVAL = getattr(config, 'maxPollInterval', 86400)
+
+# Number of failed downloads in a row after which a feed is suspended,
+# and number of seconds between two attempts to download a suspended feed
+FEED_FAILURE_THRESHOLD = getattr(config, 'feedFailureThreshold', 5)
+FEED_PROBE_INTERVAL = getattr(config, 'feedProbeInterval', 7 * 86400)
+
 
 def imapify(string):
     """ Return a version of the given string which
@@ -38,18 +119,938 @@ def imapify(string):
 """
 
 
+def unquoteMailbox(mailbox):
+    """ Returns the name of the given mailbox, which may be given as an
+    IMAP quoted string. """
+
+    if len(mailbox) >= 2 and mailbox[0] == mailbox[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', mailbox[1:-1])
+    return mailbox
+
+
+def quoteMailbox(mailbox):
+    """ Returns the given mailbox as an IMAP quoted string, in which the
+    backslashes and double quotes of its name are escaped. """
+
+    name = unquoteMailbox(mailbox)
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def parseFetch(data):
+    """ Groups the data returned by imaplib for a FETCH command into
+    one (description, literals) pair per message. The description
+    gathers every non-literal part of the response (UID, FLAGS...). """
+
+    responses = []
+    for item in data:
+        if item is None:
+            continue
+        literal = None
+        if isinstance(item, tuple):
+            item, literal = item
+        if re.match(rb'\d+ \(', item):
+            responses.append((bytearray(item), []))
+        elif responses:
+            # continuation of the previous message
+            responses[-1][0].extend(item)
+        else:
+            continue
+        if literal is not None:
+            responses[-1][1].append(literal)
+    return [(bytes(description).decode(errors='replace'), literals)
+            for description, literals in responses]
+
+
+def fetchedUID(description):
+    """ Returns the UID given in the description of a fetched message. """
+
+    matches = re.search(r'UID (\d+)', description)
+    if matches is None:
+        return None
+    return matches.groups()[0]
+
+
+def fetchedFlags(description):
+    """ Returns the list of flags given in the description
+    of a fetched message. """
+
+    matches = re.search(r'FLAGS \(([^)]*)\)', description)
+    if matches is None:
+        return []
+    return matches.groups()[0].split()
+
+
+def uidSet(string):
+    """ Returns the list of UIDs in an IMAP sequence set like "1:3,5". """
+
+    uids = []
+    for part in string.split(','):
+        if ':' in part:
+            first, last = sorted(int(uid) for uid in part.split(':'))
+            uids += range(first, last + 1)
+        elif part:
+            uids.append(int(part))
+    return uids
+
+
+def joinLiterals(lines):
+    """ Returns the lines of untagged responses given by imaplib, where
+    a literal (such as a mailbox name sent as {n}) comes as a separate
+    (line, literal) pair followed by the rest of its line, as lines in
+    which the literal is turned into a quoted string. """
+
+    joined = []
+    pending = None
+    for line in lines:
+        if line is None:
+            continue
+        if isinstance(line, tuple):
+            line, literal = line
+            quoted = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            pending = (pending or b'') + \
+                re.sub(rb'\{\d+\+?\}$', b'', line) + b'"' + quoted + b'"'
+            continue
+        if pending is not None:
+            line = pending + line
+            pending = None
+        joined.append(line)
+    if pending is not None:
+        joined.append(pending)
+    return joined
+
+
+def parseStatus(line):
+    """ Returns the mailbox name and the dictionary of integer items
+    given by a STATUS response. """
+
+    if isinstance(line, bytes):
+        line = line.decode()
+    matches = re.match(r'\s*(?:"((?:[^"\\]|\\.)*)"|(\S+)) \((.*)\)\s*$', line)
+    if matches is None:
+        return None, {}
+    quoted, atom, items = matches.groups()
+    name = atom if quoted is None else re.sub(r'\\(.)', r'\1', quoted)
+    items = items.split()
+    return name, dict((items[i].upper(), int(items[i + 1]))
+                      for i in range(0, len(items) - 1, 2))
+
+
+def parseList(line):
+    """ Returns the list of flags and the mailbox name given by a LIST
+    response. """
+
+    if isinstance(line, bytes):
+        line = line.decode()
+    matches = re.match(r'\((.*?)\) (?:"(?:[^"\\]|\\.)*"|NIL) '
+                       r'(?:"((?:[^"\\]|\\.)*)"|(\S+))', line)
+    if matches is None:
+        return [], None
+    flags, quoted, atom = matches.groups()
+    name = atom if quoted is None else re.sub(r'\\(.)', r'\1', quoted)
+    return flags.split(), name
+
+
+def publishInterval(entries, now=None):
+    """ Returns the median number of seconds between the publication
+    dates of the given feed entries, counting the time elapsed since the
+    last one. Returns None when no entry is dated. """
+
+    dates = []
+    for entry in entries:
+        date = entry.get('published_parsed') or entry.get('updated_parsed')
+        if date:
+            dates.append(calendar.timegm(date))
+    if not dates:
+        return None
+    dates = sorted(set(dates))
+    dates.append(max(time.time() if now is None else now, dates[-1]))
+    intervals = [later - earlier
+                 for earlier, later in zip(dates, dates[1:])
+                 if later > earlier]
+    if not intervals:
+        return None
+    return statistics.median(intervals)
+
+
+def feedCommandMessage(url):
+    """ Returns the bytes of a command message for the feed at the
+    given URL. """
+
+    msg = email.mime.text.MIMEText("", "plain")
+    msg['Subject'] = "feed " + str(url)
+    msg['From'] = config.authorizedSender
+    msg['To'] = config.authorizedSender
+    return msg.as_bytes()
+
+
+def appendLiteral(date, msg):
+    """ Returns the date and message arguments of an APPEND command,
+    with the message as a non-synchronizing literal (RFC 7888). """
+
+    return date.encode() + b' {' + str(len(msg)).encode() + b'+}' + \
+           imaplib.CRLF + msg
+
+
+def entryMessageId(feedURL, entry):
+    """ Returns the Message-ID of the message about a feed entry. It only
+    depends on the feed URL and on the id (or guid) of the entry, or on
+    its link when it has no id, so that it is the same each time the
+    entry is seen. """
+
+    entryId = entry.get('id') or entry.link
+    digest = hashlib.sha256((str(feedURL) + '\n' + entryId).encode())
+    return '<' + digest.hexdigest()[:32] + '@' + MESSAGE_ID_DOMAIN + '>'
+
+
+def entryDate(entry):
+    """ Returns when a feed entry was updated, or else published, as a
+    UTC time tuple, or None if it is not dated. """
+
+    if hasattr(entry, 'updated_parsed') \
+        and entry.updated_parsed is not None:
+        return entry.updated_parsed
+    if hasattr(entry, 'published_parsed') \
+        and entry.published_parsed is not None:
+        return entry.published_parsed
+    return None
+
+
+def entryTime(entry):
+    """ Returns the date of a feed entry in seconds since the epoch, or
+    None if it is not dated. """
+
+    date = entryDate(entry)
+    if date is None:
+        return None
+    return calendar.timegm(date)
+
+
+def newestFirst(entries):
+    """ Tells whether feed entries are all dated and sorted from the
+    newest to the oldest, as they are in most feeds. """
+
+    times = [entryTime(entry) for entry in entries]
+    if None in times:
+        return False
+    return all(newer >= older for newer, older in zip(times, times[1:]))
+
+
+def unseenEntries(feedURL, entries, markKey, markDate):
+    """ Returns the entries of a newest-first feed which come before the
+    newest entry delivered before, given by its key and date. """
+
+    for index, entry in enumerate(entries):
+        date = entryTime(entry)
+        if date < markDate:
+            return entries[:index]
+        if date == markDate and entry.get('link') \
+            and entryMessageId(feedURL, entry) == markKey:
+            return entries[:index]
+    return entries
+
+
+def entryFields(entry, feedURL=None):
+    """ Returns the parts of a feed entry its message is made of, as a
+    dictionary that can be sent to another process. """
+
+    date = entryDate(entry)
+    try:
+        content = entry.content[0]['value']
+    except AttributeError:
+        try:
+            content = entry.summary
+        except AttributeError:
+            content = entry.description
+    return {'title': entry.title,
+            'author': getattr(entry, 'author', None),
+            'link': entry.link,
+            'messageId': entryMessageId(feedURL, entry),
+            'date': None if date is None else tuple(date),
+            'content': content}
+
+
+def renderMessage(feedTitle, encoding, fields):
+    """ Renders a feed entry, as given by entryFields, into the bytes of
+    a message. Depends on its arguments only, so that it can run in
+    another process. """
+
+    msg = email.mime.multipart.MIMEMultipart('alternative')
+    msg.set_charset(encoding)
+    author = feedTitle
+    if fields['author'] is not None:
+        author = fields['author'] + " @ " + author
+    msg['From'] = author
+    msg['Subject'] = fields['title']
+    msg['To'] = config.username
+    date = time.localtime()
+    if fields['date'] is not None:
+        date = fields['date']
+    msg['Date'] = email.utils.format_datetime(
+                    datetime.datetime.fromtimestamp(
+                        time.mktime(date)))
+    msg['Message-ID'] = fields['messageId']
+    link = fields['link']
+    headerName = 'X-Entry-Link'
+    msg[headerName] = email.header.Header(s=link, charset=encoding)
+    html = fields['content']
+    text = HTML_CONVERTER.handle(html)
+    text = 'Retrieved from ' + link + '\n' + text
+    html = html + \
+           '<p><a href="' + \
+           link + \
+           '">Retrieved from ' + \
+           link + \
+           '</a></p>'
+    part1 = email.mime.text.MIMEText(text, 'plain')
+    part2 = email.mime.text.MIMEText(html, 'html')
+    msg.attach(part1)
+    msg.attach(part2)
+
+    bytesIO = BytesIO()
+    bytesGenerator = BytesGenerator(bytesIO,
+                                    mangle_from_=True,
+                                    maxheaderlen=60)
+    bytesGenerator.flatten(msg)
+    return bytesIO.getvalue()
+
+
+def renderKey(feedTitle, encoding, fields):
+    """ Returns a hash of everything the message rendered for a feed
+    entry depends on. """
+
+    data = json.dumps([RENDER_VERSION, html2text.__version__,
+                       config.username, feedTitle, encoding, fields],
+                      sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class YTimeoutHandler(urllib.request.BaseHandler):
+    """ Gives the requests made to download feeds a timeout, so that a
+    server which never answers does not hold up an update. """
+
+    def __init__(self, timeout=FETCH_TIMEOUT):
+
+        self.timeout = timeout
+
+
+    def http_request(self, request):
+
+        request.timeout = self.timeout
+        return request
+
+    https_request = http_request
+
+
+def feedError(parsed):
+    """ Returns why a downloaded feed cannot be used (HTTP error, network
+    error, not a feed), or None if it can. """
+
+    status = parsed.get('status')
+    if status is not None and status >= 400:
+        return 'HTTP error ' + str(status)
+    if status == 304 or parsed.get('entries') or not parsed.get('bozo'):
+        return None
+    return str(parsed.get('bozo_exception', 'Not a feed'))
+
+
+def maxAge(headers):
+    """ Returns the max-age given by the Cache-Control header of
+    an HTTP response, in seconds, or None. """
+
+    headers = dict((name.lower(), value)
+                   for name, value in (headers or {}).items())
+    matches = re.search(r'max-age\s*=\s*"?(\d+)',
+                        headers.get('cache-control', ''))
+    if matches is None:
+        return None
+    return int(matches.groups()[0])
+
+
+def retryAfter(headers, now=None):
+    """ Returns the number of seconds given by the Retry-After header of
+    an HTTP response, which can be a delay or a date, or None. """
+
+    headers = dict((name.lower(), value)
+                   for name, value in (headers or {}).items())
+    value = headers.get('retry-after', '').strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    return max(date.timestamp() - (time.time() if now is None else now), 0)
+
+
+class YStore(object):
+    """ Local state of the agent, kept in an SQLite database so that
+    it survives restarts. Can be shared between threads. """
+
+    def __init__(self, path=STATE_FILE):
+
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS validators (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                modified TEXT,
+                title TEXT);
+            CREATE TABLE IF NOT EXISTS mailboxes (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                uidnext INTEGER,
+                highestmodseq INTEGER);
+            CREATE TABLE IF NOT EXISTS entries (
+                mailbox TEXT,
+                entryKey TEXT,
+                uid INTEGER,
+                PRIMARY KEY (mailbox, entryKey));
+            CREATE TABLE IF NOT EXISTS commands (
+                mailbox TEXT,
+                uid INTEGER,
+                uidvalidity INTEGER,
+                feedURL TEXT,
+                PRIMARY KEY (mailbox, uid));
+            CREATE TABLE IF NOT EXISTS scans (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                uidnext INTEGER,
+                messages INTEGER,
+                highestmodseq INTEGER);
+            CREATE TABLE IF NOT EXISTS schedule (
+                url TEXT PRIMARY KEY,
+                nextPoll REAL,
+                interval REAL,
+                failures INTEGER);
+            CREATE TABLE IF NOT EXISTS failures (
+                url TEXT PRIMARY KEY,
+                since REAL,
+                lastError TEXT);
+            CREATE TABLE IF NOT EXISTS marks (
+                url TEXT,
+                mailbox TEXT,
+                entryKey TEXT,
+                date REAL,
+                reconciled REAL,
+                uidvalidity INTEGER,
+                PRIMARY KEY (url, mailbox));
+            CREATE TABLE IF NOT EXISTS renders (
+                renderKey TEXT PRIMARY KEY,
+                message BLOB,
+                used REAL);
+            """)
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(mailboxes)")]
+        if 'highestmodseq' not in columns:
+            self.db.execute("ALTER TABLE mailboxes "
+                            "ADD COLUMN highestmodseq INTEGER")
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(marks)")]
+        if 'uidvalidity' not in columns:
+            self.db.execute("ALTER TABLE marks ADD COLUMN uidvalidity INTEGER")
+        self.db.commit()
+
+
+    def validators(self, url):
+        """ Returns the (etag, modified, title) remembered for the feed
+        at the given URL. """
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT etag, modified, title FROM validators "
+                    "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return (None, None, None)
+        return row
+
+
+    def setValidators(self, url, etag=None, modified=None, title=None):
+        """ Remembers the HTTP validators and title of the feed at
+        the given URL. """
+
+        with self.lock:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?)",
+                    (url, etag, modified, title))
+            self.db.commit()
+
+
+    def mailboxIndex(self, mailbox):
+        """ Returns the (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ) of the given
+        mailbox when its entries were last indexed. """
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT uidvalidity, uidnext, highestmodseq "
+                    "FROM mailboxes WHERE mailbox = ?",
+                    (unquoteMailbox(mailbox),)).fetchone()
+        if row is None:
+            return (None, None, None)
+        return row
+
+
+    def resetEntries(self, mailbox, uidvalidity=None):
+        """ Forgets every entry indexed for the given mailbox, and the
+        newest entries delivered to it. """
+
+        mailbox = unquoteMailbox(mailbox)
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE mailbox = ?",
+                            (mailbox,))
+            self.db.execute("DELETE FROM marks WHERE mailbox = ?",
+                            (mailbox,))
+            self.db.execute(
+                    "INSERT OR REPLACE INTO mailboxes "
+                    "VALUES (?, ?, NULL, NULL)",
+                    (mailbox, uidvalidity))
+            self.db.commit()
+
+
+    def setMailboxIndex(self, mailbox, uidnext, highestModSeq=None):
+        """ Remembers up to which UID and which modification sequence
+        the given mailbox was indexed. """
+
+        with self.lock:
+            self.db.execute(
+                    "UPDATE mailboxes SET uidnext = ?, highestmodseq = ? "
+                    "WHERE mailbox = ?",
+                    (uidnext, highestModSeq, unquoteMailbox(mailbox)))
+            self.db.commit()
+
+
+    def addEntries(self, mailbox, entries):
+        """ Indexes (UID, entry key) pairs as delivered to the given
+        mailbox. The UID is None when it is not known yet. """
+
+        mailbox = unquoteMailbox(mailbox)
+        with self.lock:
+            self.db.executemany(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                    [(mailbox, key, uid) for uid, key in entries])
+            self.db.commit()
+
+
+    def entryKeys(self, mailbox):
+        """ Returns the set of entry keys indexed for the given mailbox. """
+
+        with self.lock:
+            rows = self.db.execute(
+                    "SELECT entryKey FROM entries WHERE mailbox = ?",
+                    (unquoteMailbox(mailbox),)).fetchall()
+        return set(row[0] for row in rows)
+
+
+    def indexedUIDs(self, mailbox):
+        """ Returns the set of UIDs of entries indexed for the given
+        mailbox. """
+
+        with self.lock:
+            rows = self.db.execute(
+                    "SELECT uid FROM entries "
+                    "WHERE mailbox = ? AND uid IS NOT NULL",
+                    (unquoteMailbox(mailbox),)).fetchall()
+        return set(row[0] for row in rows)
+
+
+    def scannedStatus(self, mailbox):
+        """ Returns the status of the given mailbox when it was last
+        searched for commands, as a dictionary. """
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT uidvalidity, uidnext, messages, highestmodseq "
+                    "FROM scans WHERE mailbox = ?",
+                    (unquoteMailbox(mailbox),)).fetchone()
+        if row is None:
+            return None
+        status = dict(zip(['UIDVALIDITY', 'UIDNEXT', 'MESSAGES',
+                           'HIGHESTMODSEQ'], row))
+        if status['HIGHESTMODSEQ'] is None:
+            del status['HIGHESTMODSEQ']
+        return status
+
+
+    def registerCommands(self, mailbox, status, commands, replace=True):
+        """ Remembers the (UID, feed URL) pairs of feed commands found in
+        the given mailbox, and the status of this mailbox. Previously
+        registered commands of that mailbox are forgotten unless replace
+        is False. """
+
+        mailbox = unquoteMailbox(mailbox)
+        with self.lock:
+            if replace:
+                self.db.execute("DELETE FROM commands WHERE mailbox = ?",
+                                (mailbox,))
+            self.db.executemany(
+                    "INSERT OR REPLACE INTO commands VALUES (?, ?, ?, ?)",
+                    [(mailbox, int(uid), status.get('UIDVALIDITY'), url)
+                     for uid, url in commands])
+            self.db.execute(
+                    "INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?)",
+                    (mailbox,
+                     status.get('UIDVALIDITY'),
+                     status.get('UIDNEXT'),
+                     status.get('MESSAGES'),
+                     status.get('HIGHESTMODSEQ')))
+            self.db.commit()
+
+
+    def registeredCommands(self, mailbox):
+        """ Returns the (UID, feed URL) pairs of feed commands registered
+        for the given mailbox. """
+
+        with self.lock:
+            rows = self.db.execute(
+                    "SELECT c.uid, c.feedURL FROM commands c, scans s "
+                    "WHERE c.mailbox = ? AND s.mailbox = c.mailbox "
+                    "AND s.uidvalidity IS c.uidvalidity ORDER BY c.uid",
+                    (unquoteMailbox(mailbox),)).fetchall()
+        return [(str(uid), url) for uid, url in rows]
+
+
+    def forgetCommand(self, mailbox, uid):
+        """ Forgets a feed command which was removed from its mailbox. """
+
+        with self.lock:
+            self.db.execute(
+                    "DELETE FROM commands WHERE mailbox = ? AND uid = ?",
+                    (unquoteMailbox(mailbox), int(uid)))
+            self.db.commit()
+
+
+    def forgetMailboxesExcept(self, mailboxes):
+        """ Forgets the commands of every mailbox not in the given list. """
+
+        mailboxes = set(unquoteMailbox(mailbox) for mailbox in mailboxes)
+        with self.lock:
+            gone = [(row[0],) for row in
+                    self.db.execute("SELECT mailbox FROM scans").fetchall()
+                    if row[0] not in mailboxes]
+            for table in ['commands', 'scans']:
+                self.db.executemany(
+                        "DELETE FROM " + table + " WHERE mailbox = ?", gone)
+            self.db.commit()
+
+
+    def removeEntries(self, mailbox, uids):
+        """ Forgets the entries with given UIDs in the given mailbox. """
+
+        mailbox = unquoteMailbox(mailbox)
+        with self.lock:
+            self.db.executemany(
+                    "DELETE FROM entries WHERE mailbox = ? AND uid = ?",
+                    [(mailbox, uid) for uid in uids])
+            self.db.commit()
+
+
+    def schedules(self):
+        """ Returns a dictionary giving the (next poll time, interval,
+        number of failures) of every scheduled feed URL. """
+
+        with self.lock:
+            rows = self.db.execute(
+                    "SELECT url, nextPoll, interval, failures "
+                    "FROM schedule").fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+
+    def setSchedule(self, url, nextPoll, interval, failures=0):
+        """ Remembers when the feed at the given URL is to be polled. """
+
+        with self.lock:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO schedule VALUES (?, ?, ?, ?)",
+                    (url, nextPoll, interval, failures))
+            self.db.commit()
+
+
+    def forgetSchedulesExcept(self, urls):
+        """ Forgets the schedule, failures, validators and newest delivered
+        entries of every feed URL not in the given list. """
+
+        urls = set(urls)
+        with self.lock:
+            for table in ['schedule', 'failures', 'marks', 'validators']:
+                gone = [(row[0],) for row in
+                        self.db.execute("SELECT url FROM " + table).fetchall()
+                        if row[0] not in urls]
+                self.db.executemany(
+                        "DELETE FROM " + table + " WHERE url = ?", gone)
+            self.db.commit()
+
+
+    def mark(self, url, mailbox):
+        """ Returns the (key, date) of the newest entry of the feed at the
+        given URL delivered to the given mailbox, when all entries of this
+        feed were last checked and the UIDVALIDITY the mailbox had then, or
+        (None, None, None, None). """
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT entryKey, date, reconciled, uidvalidity "
+                    "FROM marks WHERE url = ? AND mailbox = ?",
+                    (url, unquoteMailbox(mailbox))).fetchone()
+        if row is None:
+            return (None, None, None, None)
+        return row
+
+
+    def setMark(self, url, mailbox, uidvalidity, entryKey, date, reconciled):
+        """ Remembers the newest entry of the feed at the given URL
+        delivered to the given mailbox, which has the given
+        UIDVALIDITY. """
+
+        with self.lock:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO marks VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, unquoteMailbox(mailbox), entryKey, date, reconciled,
+                     uidvalidity))
+            self.db.commit()
+
+
+    def failure(self, url):
+        """ Returns since when the feed at the given URL fails to be
+        downloaded and the last error, or (None, None). """
+
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT since, lastError FROM failures WHERE url = ?",
+                    (url,)).fetchone()
+        if row is None:
+            return (None, None)
+        return row
+
+
+    def setFailure(self, url, error, since=None):
+        """ Remembers the last error of a feed, and since when it fails
+        if it did not fail before. """
+
+        with self.lock:
+            self.db.execute(
+                    "INSERT OR IGNORE INTO failures VALUES (?, ?, NULL)",
+                    (url, time.time() if since is None else since))
+            self.db.execute(
+                    "UPDATE failures SET lastError = ? WHERE url = ?",
+                    (error, url))
+            self.db.commit()
+
+
+    def forgetFailure(self, url):
+        """ Forgets the failures of a feed that could be downloaded. """
+
+        with self.lock:
+            self.db.execute("DELETE FROM failures WHERE url = ?", (url,))
+            self.db.commit()
+
+
+    def renderedMessages(self, keys):
+        """ Returns a dictionary of the messages rendered before for the
+        given render keys, when they are still kept. """
+
+        messages = {}
+        keys = list(keys)
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                messages.update(self.db.execute(
+                        "SELECT renderKey, message FROM renders "
+                        "WHERE renderKey IN (" + \
+                        ",".join("?" * len(batch)) + ")", batch).fetchall())
+            if messages:
+                self.db.executemany(
+                        "UPDATE renders SET used = ? WHERE renderKey = ?",
+                        [(time.time(), key) for key in messages])
+                self.db.commit()
+        return dict((key, bytes(message))
+                    for key, message in messages.items())
+
+
+    def addRenderedMessages(self, messages, size=RENDER_CACHE_SIZE):
+        """ Keeps (render key, message) pairs, forgetting the least
+        recently used messages beyond the given number. """
+
+        with self.lock:
+            self.db.executemany(
+                    "INSERT OR REPLACE INTO renders VALUES (?, ?, ?)",
+                    [(key, message, time.time())
+                     for key, message in messages])
+            self.db.execute(
+                    "DELETE FROM renders WHERE renderKey NOT IN "
+                    "(SELECT renderKey FROM renders "
+                    "ORDER BY used DESC LIMIT ?)", (size,))
+            self.db.commit()
+
+
+
+class YScheduler(object):
+    """ Decides when each feed is downloaded next, given how often it
+    publishes entries, what it says about its own refresh rate (RSS ttl,
+    HTTP Cache-Control and Retry-After) and how often it failed. Feeds
+    are kept in a priority queue ordered by their next poll time.
+
+    A feed failing failureThreshold times in a row is suspended : it is
+    then only tried once every probeInterval, until it works again. """
+
+    def __init__(self, store=None,
+                 minInterval=MIN_POLL_INTERVAL,
+                 maxInterval=MAX_POLL_INTERVAL,
+                 failureThreshold=FEED_FAILURE_THRESHOLD,
+                 probeInterval=FEED_PROBE_INTERVAL):
+
+        self.store = store
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.failureThreshold = failureThreshold
+        self.probeInterval = probeInterval
+
+        # (next poll time, interval, number of failures) by feed URL
+        self.polls = store.schedules() if store is not None else {}
+
+        # (next poll time, URL) heap, possibly with outdated items
+        self.queue = [(poll[0], url) for url, poll in self.polls.items()]
+        heapq.heapify(self.queue)
+        self.lock = threading.Lock()
+
+
+    def isDue(self, url, now=None):
+        """ Tells whether the feed at the given URL has to be downloaded.
+        Feeds never downloaded before are always due. """
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return url not in self.polls or self.polls[url][0] <= now
+
+
+    def isFailing(self, url):
+        """ Tells whether the last download of the feed at the given URL
+        failed. """
+
+        with self.lock:
+            return url in self.polls and self.polls[url][2] > 0
+
+
+    def isSuspended(self, url):
+        """ Tells whether the feed at the given URL failed too many times
+        in a row to be downloaded as usual. """
+
+        with self.lock:
+            return url in self.polls and \
+                   self.polls[url][2] >= self.failureThreshold
+
+
+    def nextPoll(self):
+        """ Returns the time when the next feed is due, or None when
+        no feed is scheduled. """
+
+        with self.lock:
+            while self.queue:
+                nextPoll, url = self.queue[0]
+                if url in self.polls and self.polls[url][0] == nextPoll:
+                    return nextPoll
+                heapq.heappop(self.queue)
+        return None
+
+
+    def schedule(self, url, interval, failures=0, delay=None, now=None):
+        """ Schedules the next download of the feed at the given URL.
+        The delay defaults to the interval, doubled by each failure. """
+
+        if now is None:
+            now = time.time()
+        interval = min(max(interval, self.minInterval), self.maxInterval)
+        if failures >= self.failureThreshold:
+            delay = self.probeInterval
+        elif delay is None:
+            delay = min(interval * 2 ** min(failures, 32), self.maxInterval)
+        delay = max(delay, self.minInterval)
+        with self.lock:
+            self.polls[url] = (now + delay, interval, failures)
+            heapq.heappush(self.queue, (now + delay, url))
+        if self.store is not None:
+            self.store.setSchedule(url, now + delay, interval, failures)
+        logging.debug("Next download of " + url + " in " + \
+                      str(int(delay)) + " seconds.")
+
+
+    def fetched(self, url, parsed, now=None):
+        """ Schedules the next download of a feed given the result of
+        its last successful download. """
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            nextPoll, interval, failures = \
+                self.polls.get(url, (None, self.minInterval, 0))
+        if failures > 0:
+            if failures >= self.failureThreshold:
+                logging.info("Resuming feed: " + url)
+            if self.store is not None:
+                self.store.forgetFailure(url)
+        status = parsed.get('status')
+        headers = parsed.get('headers')
+        if status != 304:
+            interval = publishInterval(parsed.get('entries', []), now) \
+                       or interval
+        try:
+            interval = max(interval, int(parsed.feed.get('ttl')) * 60)
+        except (AttributeError, TypeError, ValueError):
+            pass
+        interval = max(interval,
+                       maxAge(headers) or 0,
+                       retryAfter(headers, now) or 0)
+        self.schedule(url, interval, now=now)
+
+
+    def failed(self, url, error, delay=None, now=None):
+        """ Delays the next download of a feed that could not be
+        downloaded, exponentially with the number of failures. Returns
+        True when this failure suspends the feed. """
+
+        with self.lock:
+            nextPoll, interval, failures = \
+                self.polls.get(url, (None, self.minInterval, 0))
+        failures += 1
+        if delay is not None:
+            delay = max(delay, interval * 2 ** min(failures, 32))
+        if self.store is not None:
+            self.store.setFailure(url, error, now)
+        self.schedule(url, interval, failures, delay, now)
+        if failures == self.failureThreshold:
+            logging.warning("Suspending feed after " + str(failures) + \
+                            " failures: " + url)
+            return True
+        return False
+
+
+    def keep(self, urls):
+        """ Forgets the schedule of every feed whose URL is not given. """
+
+        urls = set(urls)
+        with self.lock:
+            for url in list(self.polls):
+                if url not in urls:
+                    del self.polls[url]
+        if self.store is not None:
+            self.store.forgetSchedulesExcept(urls)
+
+
 class YFeed(object):
     """ This is a yarss2imap RSS feed mapped to an IMAP mailbox. """
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, parsed=None, agent=None):
 
         # URL of the feed
         self.url = url
 
-        # Parsed feed
-        self.feed = None
-        if url is not None:
-            self.feed = feedparser.parse(url)
+        # Agent which downloads the feed when it is first needed
+        self.agent = agent
+
+        # Parsed feed, unless it is not downloaded yet
+        self._feed = parsed
 
         # Title of the feed
         self._title = None
@@ -61,16 +1062,52 @@ class YFeed(object):
         self._mailbox = None
 
 
+    @property
+    def feed(self):
+        """ Returns the parsed feed, downloaded when first needed. """
+
+        if self._feed is None and self.url is not None:
+            if self.agent is not None:
+                self._feed = self.agent.cachedFeed(self.url)
+            else:
+                self._feed = feedparser.parse(self.url,
+                                               handlers=[YTimeoutHandler()])
+        return self._feed
+
+
+    def refresh(self):
+        """ Downloads the feed again without validators, when it was not
+        modified but all of its entries are needed anyway. Returns why
+        it could not be used, or None. """
+
+        try:
+            parsed = self.agent.fetch(self.url, conditional=False)
+        except Exception:
+            return str(sys.exc_info()[1])
+        error = feedError(parsed)
+        if error is None:
+            self._feed = parsed
+        return error
+
+
     def title(self, title=None):
-        """ Returns the title of the feed. """
+        """ Returns the title of the feed, which is downloaded if the
+        title is not known yet. """
 
         if title is not None:
             self._title = title
         if self._title is not None:
             return self._title
+        feed = self.feed
+        if self.notModified() and self.agent is not None:
+            # Nothing was downloaded, use the title we got last time
+            self._title = self.agent.store.validators(self.url)[2]
+            if self._title is not None:
+                return self._title
+            feed = self.agent.fetch(self.url, conditional=False)
         self._title = 'No title'
         try:
-            self._title = self.feed.feed.title
+            self._title = feed.feed.title
         except AttributeError:
             pass
         return self._title
@@ -86,6 +1123,13 @@ class YFeed(object):
         return self._safeTitle
 
 
+    def notModified(self):
+        """ Tells whether the server answered that the feed has not
+        changed since it was last fetched. """
+
+        return self._feed is not None and self._feed.get('status') == 304
+
+
     def mailbox(self,
                 agent=None,
                 targetMailbox='INBOX.' + config.mailbox):
@@ -96,8 +1140,11 @@ class YFeed(object):
         if agent is None:
             return None
 
+        self._mailbox = quoteMailbox(targetMailbox)
+        if unquoteMailbox(self._mailbox) in agent.knownMailboxes:
+            return self._mailbox
+
         # Create one
-        self._mailbox = targetMailbox
         logging.info("Creating mailbox: " + self._mailbox)
         status, message = agent.imap.create(self._mailbox)
         if status != 'OK':
@@ -108,120 +1155,111 @@ class YFeed(object):
         if status != 'OK':
             logging.error("Could not subscribe to mailbox: " + self._mailbox)
             logging.error("    error message was: " + str(message))
+        agent.knownMailboxes.add(unquoteMailbox(self._mailbox))
         return self._mailbox
 
 
-    def createMessage(self, entry=None):
-        """ Creates a message representing a given feed entry. """
+    def renderJob(self, entry):
+        """ Returns the (feed title, encoding, entry fields) arguments of
+        renderMessage for a given feed entry. """
 
         logging.info("Creating message about: " + entry.title)
-        msg = email.mime.multipart.MIMEMultipart('alternative')
-        msg.set_charset(self.feed.encoding)
-        author = self.title()
-        try:
-            author = entry.author + " @ " + author
-        except AttributeError:
-            pass
-        msg['From'] = author
-        msg['Subject'] = entry.title
-        msg['To'] = config.username
-        date = time.time()
-        if hasattr(entry, 'updated_parsed') \
-            and entry.updated_parsed is not None:
-            date = entry.updated_parsed
-        elif hasattr(entry, 'published_parsed') \
-            and entry.published_parsed is not None:
-            date = entry.published_parsed
-        else:
+        fields = entryFields(entry, self.url)
+        if fields['date'] is None:
             logging.warning('Entry without a date: ' + entry.title)
-        if date is not None:
-            msg['Date'] = email.utils.format_datetime(
-                            datetime.datetime.fromtimestamp(
-                                time.mktime(date)))
-        headerName = 'X-Entry-Link'
-        msg[headerName] = email.header.Header(s=entry.link,
-                                              charset=self.feed.encoding)
-        try:
-            content = entry.content[0]['value']
-        except AttributeError:
-            try:
-                content = entry.summary
-            except AttributeError:
-                content = entry.description
-        html = content
-        text = html2text.html2text(html)
-        text = 'Retrieved from ' + entry.link + '\n' + text
-        html = html + \
-               '<p><a href="' + \
-               entry.link + \
-               '">Retrieved from ' + \
-               entry.link + \
-               '</a></p>'
-        part1 = email.mime.text.MIMEText(text, 'plain')
-        part2 = email.mime.text.MIMEText(html, 'html')
-        msg.attach(part1)
-        msg.attach(part2)
-
-        bytesIO = BytesIO()
-        bytesGenerator = BytesGenerator(bytesIO,
-                                        mangle_from_=True,
-                                        maxheaderlen=60)
-        bytesGenerator.flatten(msg)
-        text = bytesIO.getvalue()
-
-        return text
+        return (self.title(), self.feed.encoding, fields)
+
+
+    def createMessage(self, entry=None):
+        """ Creates a message representing a given feed entry. """
+
+        return renderMessage(*self.renderJob(entry))
 
 
     def updateEntries(self, agent=None):
         """ Guarantees that there is one message in the given mailbox
-        for each entry in the feed. """
+        for each entry in the feed. Returns True if there is one for every
+        new entry, False if some could not be appended. """
 
         if agent is None:
-            return
+            return False
 
         mailbox = self.mailbox(agent=agent)
 
+        # Entries older than the newest one delivered before were seen
+        # already, unless the feed is not newest-first. All of them are
+        # checked again now and then, in case some were missed. Those
+        # delivered before the mailbox was recreated do not count.
+        entries = self.feed.entries
+        now = time.time()
+        markKey, markDate, reconciled, markValidity = \
+            agent.store.mark(self.url, mailbox)
+        full = markDate is None \
+            or markValidity != agent.uidValidity(mailbox) \
+            or now - reconciled >= FULL_UPDATE_INTERVAL \
+            or not newestFirst(entries)
+        if not full:
+            entries = unseenEntries(self.url, entries, markKey, markDate)
+            if len(entries) == 0:
+                logging.info("No new entries in feed: " + self.url)
+                return True
+
         # Create one message per feed item
-        nbOfEntries = str(len(self.feed.entries))
+        nbOfEntries = str(len(entries))
         logging.info("Examining " + nbOfEntries + " feed entries.")
-        agent.select(mailbox=mailbox)
-        for entry in self.feed.entries:
+        agent.select(mailbox=mailbox, readonly=True)
+        uidvalidity = agent.selectedState.get('UIDVALIDITY')
+        knownKeys = agent.deliveredEntries(mailbox)
+        if knownKeys is None:
+            logging.error("Could not list entries already in mailbox: " + \
+                          mailbox)
+            return False
+        newEntries = []
+        newest = None
+        for entry in entries:
 
             if hasattr(entry, 'link') is False or \
                 entry.link is None or \
                 entry.link == '':
                 logging.error('Could not update entry titled: ' + entry.title)
                 continue
+            if newest is None:
+                newest = (entryMessageId(self.url, entry), entryTime(entry))
 
-            # Is there already a message for this entry ?
-            headerName = 'X-Entry-Link'
-            try:
-                agent.imap.literal = entry.link.encode(self.feed.encoding)
-                # ^-- this is an undocumented imaplib feature
-                status, data = agent.imap.uid(
-                    'search',
-                    'CHARSET',
-                    self.feed.encoding,
-                    'UNDELETED HEADER ' + headerName)
-            except:
-                logging.error('Could not search for entry titled: ' + \
-                              entry.title)
-                status = 'KO'
-                data = [None]
-            if status == 'OK' and data[0] not in [None, b'']:
+            # Is there already a message for this entry ? Messages
+            # appended before entries had a Message-ID are known by link.
+            messageId = entryMessageId(self.url, entry)
+            if messageId in knownKeys or entry.link in knownKeys:
                 # There is already one, move on !
                 continue
-            elif status != 'OK':
-                logging.error('Could not search for entry URL: ' + entry.link)
-
-            msg = self.createMessage(entry=entry)
-            status, error = agent.imap.append(
-                    mailbox,
-                    '',
-                    imaplib.Time2Internaldate(time.time()),
-                    msg)
-            if status != 'OK':
-                logging.error('Could not append message: ' + error)
+            knownKeys.add(messageId)
+            newEntries.append((messageId, self.renderJob(entry)))
+
+        # Messages are appended by batches as soon as they are rendered
+        keys = [key for key, job in newEntries]
+        batch = []
+        failed = False
+        for index, message in enumerate(agent.renderer.render(
+                                    [job for key, job in newEntries])):
+            batch.append((keys[index], message))
+            if len(batch) < APPEND_BATCH and index < len(keys) - 1:
+                continue
+            results = agent.appendMessages(mailbox,
+                                           [msg for key, msg in batch])
+            agent.store.addEntries(mailbox,
+                                   [(None, key) for (key, msg), (status, error)
+                                    in zip(batch, results)
+                                    if status == 'OK'])
+            failed = failed or any(status != 'OK'
+                                   for status, error in results)
+            batch = []
+
+        # Entries which could not be appended are tried again next time
+        if newest is not None and not failed and uidvalidity is not None:
+            agent.store.setMark(self.url, mailbox, uidvalidity,
+                                newest[0], newest[1],
+                                now if full else reconciled)
+        return not failed
 
 
     def createMailbox(self,
@@ -241,19 +1279,16 @@ class YFeed(object):
         if agent is None:
             logging.error('Could not create mailbox without '
                           'an IMAP agent: ' + str(self.url))
-        path = '"' + parentMailbox.strip('"') + '.' + self.safeTitle() + '"'
+        path = quoteMailbox(unquoteMailbox(parentMailbox) + '.' + \
+                            self.safeTitle())
         agent.select(mailbox=path)
         if self.url is None:
             return path
-        msg = email.mime.text.MIMEText("", "plain")
-        msg['Subject'] = "feed " + str(self.url)
-        msg['From'] = config.authorizedSender
-        msg['To'] = config.authorizedSender
         status, error = agent.imap.append(
                 path,
                 '',
                 imaplib.Time2Internaldate(time.time()),
-                msg.as_bytes())
+                feedCommandMessage(self.url))
         if status != 'OK':
             logging.error('Could not append message: ' + str(error))
         else:
@@ -270,8 +1305,7 @@ class YCommandMessage(object):
         self.message = message
         self.mailbox = mailbox
         if mailbox is not None:
-            if self.mailbox[0] != '"':
-                self.mailbox = '"' + self.mailbox + '"'
+            self.mailbox = quoteMailbox(mailbox)
         self.messageUID = messageUID
         self.agent = agent
 
@@ -293,8 +1327,10 @@ class YCommandMessage(object):
                           self.messageUID + \
                           " in mailbox: " + \
                           self.mailbox)
-            logging.error("Error message was: " + msg)
-        return status
+            logging.error("Error message was: " + str(msg))
+            return status
+        self.agent.store.forgetCommand(self.mailbox, self.messageUID)
+        return self.agent.expungeUID(self.messageUID)
 
 
 class YImportCommandMessage(YCommandMessage):
@@ -343,27 +1379,62 @@ class YImportCommandMessage(YCommandMessage):
             logging.error("Could not import OPML when OPML is None.")
             return
 
-        # Create mailboxes for OPML content
+        # Plan the hierarchy of mailboxes while reading outlines : one
+        # (feed, index of parent outline) pair per outline
         logging.info("Importing 1 OPML file.")
-        root = ElementTree.fromstring(self.opml)
-
-        def createMailboxes(root, rootMailbox):
-            """ Creates a mailbox under the given rootMailbox
-            for each child of the given root outline. """
-
-            for child in root.getchildren():
-                childMailbox = rootMailbox
-                if child.tag == 'outline':
-                    url = child.get('xmlUrl')
-                    title = child.get('title')
-                    feed = YFeed(url)
-                    if title is not None:
-                        feed.title(title)
-                    childMailbox = feed.createMailbox(agent=self.agent,
-                                                      parentMailbox=rootMailbox)
-                createMailboxes(child, childMailbox)
-
-        createMailboxes(root, underMailbox)
+        outlines = []
+        untitled = []
+        parents = []
+        if isinstance(self.opml, str):
+            source = StringIO(self.opml)
+        else:
+            source = BytesIO(self.opml)
+        try:
+            for event, element in ElementTree.iterparse(
+                                    source, events=('start', 'end')):
+                if element.tag != 'outline':
+                    continue
+                if event == 'end':
+                    parents.pop()
+                    element.clear()
+                    continue
+                feed = YFeed(element.get('xmlUrl'), agent=self.agent)
+                title = element.get('title') or element.get('text')
+                if title is not None:
+                    feed.title(title)
+                elif feed.url is not None:
+                    untitled.append(feed)
+                outlines.append((feed, parents[-1] if parents else None))
+                parents.append(len(outlines) - 1)
+        except ElementTree.ParseError:
+            logging.error("Could not parse OPML: " + str(sys.exc_info()[1]))
+            return
+        logging.info("Found " + str(len(outlines)) + " outlines, " + \
+                     str(len(untitled)) + " of them without a title.")
+
+        # Feeds without a title are downloaded to get one
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=FETCH_WORKERS) as executor:
+            for count, title in enumerate(executor.map(YFeed.title,
+                                                       untitled)):
+                if (count + 1) % 50 == 0 or count + 1 == len(untitled):
+                    logging.info("Found the titles of " + str(count + 1) + \
+                                 "/" + str(len(untitled)) + " feeds.")
+
+        paths = []
+        for feed, parent in outlines:
+            parentMailbox = underMailbox if parent is None else paths[parent]
+            paths.append(quoteMailbox(unquoteMailbox(parentMailbox) + '.' + \
+                                      feed.safeTitle()))
+        self.agent.createMailboxes(paths)
+
+        # One command message per feed mailbox
+        results = self.agent.appendEach(
+                [(path, feedCommandMessage(feed.url))
+                 for (feed, parent), path in zip(outlines, paths)
+                 if feed.url is not None])
+        if any(status != 'OK' for status, data in results):
+            logging.error("Could not create every feed command message.")
         return self.remove()
 
 
@@ -375,13 +1446,18 @@ class YFeedCommandMessage(YCommandMessage):
 
     """
 
-    def __init__(self, message=None, mailbox=None, messageUID=None, agent=None):
+    def __init__(self, message=None, mailbox=None, messageUID=None, agent=None,
+                 feedURL=None):
 
         YCommandMessage.__init__(self,
                                  message=message,
                                  mailbox=mailbox,
                                  messageUID=messageUID,
                                  agent=agent)
+        # The URL is known when the command comes from the registry
+        self.feedURL = feedURL
+        if message is None:
+            return
         subject = message['Subject']
         matches = re.search(r'feed\s+(http.*)', subject)
         if matches is None:
@@ -398,17 +1474,17 @@ class YFeedCommandMessage(YCommandMessage):
 
         logging.info("Updating feed from URL: " + self.feedURL)
         # Create a mailbox for that feed
-        feed = YFeed(self.feedURL)
+        feed = YFeed(self.feedURL,
+                     parsed=self.agent.feeds.get(self.feedURL),
+                     agent=self.agent)
         logging.info("This feed has this title: " + feed.title())
 
         # If needed, move that feed message to the feed mailbox
         if self.mailbox in ['INBOX', '"INBOX"']:
             # This feed needs its own mailbox.
-            newMailbox = '"' + \
-                         underMailbox.strip('"') + \
-                         '.' + \
-                         feed.safeTitle() + \
-                         '"'
+            newMailbox = quoteMailbox(unquoteMailbox(underMailbox) + \
+                                      '.' + \
+                                      feed.safeTitle())
             feedMailbox = feed.mailbox(agent=self.agent,
                                        targetMailbox=newMailbox)
         else:
@@ -425,16 +1501,355 @@ class YFeedCommandMessage(YCommandMessage):
             self.agent.select(mailbox=feedMailbox)
             self.mailbox = feedMailbox
 
-        # Now update entries in that mailbox
-        feed.updateEntries(agent=self.agent)
+        if feed.notModified():
+            if self.agent.indexed(feedMailbox):
+                logging.info("Feed not modified since last update: " + \
+                             self.feedURL)
+                return 'OK'
+            # The mailbox is new or was recreated, it needs every entry
+            error = feed.refresh()
+            if error is not None:
+                logging.error("Could not fetch feed from URL: " + \
+                              self.feedURL)
+                logging.error("    error was: " + error)
+                return 'OK'
+
+        # Now update entries in that mailbox. Unless they were all
+        # delivered, the feed must be downloaded in full next time.
+        if feed.updateEntries(agent=self.agent):
+            self.agent.feedUpdated(feed)
         return 'OK'
 
 
+    def suspend(self):
+        """ Tells in the mailbox of this command that its feed is
+        suspended because it could not be downloaded. """
+
+        since, error = self.agent.store.failure(self.feedURL)
+        msg = email.mime.text.MIMEText(
+                "yarss2imap could not download the feed at\n\n" + \
+                "    " + self.feedURL + "\n\n" + \
+                str(FEED_FAILURE_THRESHOLD) + " times in a row since " + \
+                time.strftime('%Y-%m-%d %H:%M',
+                              time.localtime(since or time.time())) + \
+                ". The last error was:\n\n    " + str(error) + "\n\n" + \
+                "From now on, it will only be tried once every " + \
+                "%g days, " % (FEED_PROBE_INTERVAL / 86400) + \
+                "and updated again as soon as it works. Delete the\n" + \
+                "command message of this feed to stop trying.\n",
+                'plain', 'utf-8')
+        msg['From'] = 'yarss2imap'
+        msg['Subject'] = 'Feed suspended: ' + self.feedURL
+        msg['To'] = config.username
+        msg['Date'] = email.utils.formatdate(localtime=True)
+        logging.info("Telling that feed is suspended: " + self.feedURL)
+        status, error = self.agent.appendMessages(self.mailbox,
+                                                  [msg.as_bytes()])[0]
+        if status != 'OK':
+            logging.error('Could not append message: ' + str(error))
+
+
+
+class YAgentPool(object):
+    """ A pool of logged in agents, each one with its own IMAP connection
+    and selected mailbox, sharing the state of a parent agent. """
+
+    def __init__(self,
+                 parent=None,
+                 size=IMAP_CONNECTIONS,
+                 lifetime=IMAP_CONNECTION_LIFETIME):
+
+        self.parent = parent
+        self.size = size
+        self.lifetime = lifetime
+
+        # Agents waiting to be used, with their creation time
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Lends an agent of the pool. Its connection is renewed when it
+        is too old or when it was broken while being used. """
+
+        self.slots.acquire()
+        try:
+            agent = None
+            with self.lock:
+                while self.idle and agent is None:
+                    agent, created = self.idle.pop()
+                    if time.time() - created > self.lifetime:
+                        self.discard(agent)
+                        agent = None
+            if agent is None:
+                agent = self.parent.spawn()
+                created = time.time()
+            broken = False
+            try:
+                yield agent
+            except (imaplib.IMAP4.abort, OSError):
+                broken = True
+                raise
+            finally:
+                if broken:
+                    logging.warning("Recycling broken IMAP connection.")
+                    self.discard(agent)
+                else:
+                    with self.lock:
+                        self.idle.append((agent, created))
+        finally:
+            self.slots.release()
+
+
+    def discard(self, agent):
+        """ Logs out of the connection of an agent, if still possible. """
+
+        try:
+            agent.logout()
+        except Exception:
+            pass
+
+
+    def close(self):
+        """ Logs out of every idle connection. """
+
+        with self.lock:
+            for agent, created in self.idle:
+                self.discard(agent)
+            self.idle = []
+
+
+
+class YRenderer(object):
+    """ Renders feed entries into messages using a pool of processes,
+    so that rendering uses every core while IMAP connections are busy.
+    Rendered messages are kept in memory and in the store, so that
+    entries seen again are not rendered again. Can be shared between
+    threads. """
+
+    def __init__(self, store=None, workers=RENDER_WORKERS,
+                 memorySize=RENDER_MEMORY_CACHE_SIZE):
+
+        self.store = store
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+        # Most recently rendered messages by render key, latest last
+        self.memory = collections.OrderedDict()
+        self.memorySize = memorySize
+
+
+    def pool(self):
+        """ Returns the pool of processes, started when first needed. """
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+
+    def cached(self, keys):
+        """ Returns a dictionary of the messages already rendered for
+        the given render keys. """
+
+        messages = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    messages[key] = self.memory[key]
+        missing = [key for key in keys if key not in messages]
+        if self.store is not None and missing:
+            messages.update(self.store.renderedMessages(missing))
+        return messages
+
+
+    def remember(self, key, message):
+        """ Keeps a rendered message in memory. """
+
+        with self.lock:
+            self.memory[key] = message
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memorySize:
+                self.memory.popitem(last=False)
+
+
+    def render(self, jobs):
+        """ Renders (feed title, encoding, entry fields) jobs into
+        messages, see renderMessage. Messages are yielded in the order of
+        the jobs as soon as they are ready. """
+
+        started = time.time()
+        keys = [renderKey(*job) for job in jobs]
+        cached = self.cached(keys)
+        missing = [job for key, job in zip(keys, jobs) if key not in cached]
+        messages = self.renderMissing(missing)
+        rendered = []
+        for key in keys:
+            if key in cached:
+                message = cached[key]
+            else:
+                message = next(messages)
+                rendered.append((key, message))
+            self.remember(key, message)
+            yield message
+        if self.store is not None and rendered:
+            self.store.addRenderedMessages(rendered)
+        if jobs:
+            elapsed = max(time.time() - started, 1e-6)
+            logging.info("Rendered " + str(len(rendered)) + " messages " + \
+                         "and found " + str(len(jobs) - len(rendered)) + \
+                         " already rendered in %.2f seconds " % elapsed + \
+                         "(%.1f messages per second)." % \
+                         (len(jobs) / elapsed))
+
+
+    def renderMissing(self, jobs):
+        """ Renders given jobs, in the pool of processes if there are
+        several of them, and yields the messages in the order of jobs. """
+
+        rendered = 0
+        if self.workers > 1 and len(jobs) > 1:
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            try:
+                for message in self.pool().map(renderMessage,
+                                               *zip(*jobs),
+                                               chunksize=chunksize):
+                    rendered += 1
+                    yield message
+            except concurrent.futures.process.BrokenProcessPool:
+                logging.error("Rendering processes stopped, " + \
+                              "rendering in the main process.")
+                self.close()
+        for job in jobs[rendered:]:
+            yield renderMessage(*job)
+            rendered += 1
+
+
+    def close(self):
+        """ Stops the pool of processes. """
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
+
+class YIdleWatcher(threading.Thread):
+    """ Watches a mailbox over a dedicated IMAP connection in IDLE state
+    (RFC 2177) and sets the arrived event as soon as a message
+    reaches it. """
+
+    def __init__(self, parent=None, mailbox='INBOX', refresh=IDLE_REFRESH):
+
+        threading.Thread.__init__(self, daemon=True)
+        self.parent = parent
+        self.mailbox = mailbox
+        self.refresh = refresh
+
+        # Set when a new message is in the mailbox
+        self.arrived = threading.Event()
+
+        self.stopping = threading.Event()
+
+
+    def run(self):
+
+        logging.info("Watching mailbox: " + self.mailbox)
+        while not self.stopping.is_set():
+            agent = None
+            try:
+                agent = self.parent.spawn()
+                if 'IDLE' not in agent.imap.capabilities:
+                    logging.warning("IMAP server does not support IDLE.")
+                    agent.logout()
+                    return
+                agent.select(self.mailbox)
+                # Responses are read without read-ahead from now on, so
+                # that select() tells whether one is waiting
+                agent.imap.file = agent.imap.sock.makefile('rb', buffering=0)
+                while not self.stopping.is_set():
+                    self.idle(agent)
+                agent.logout()
+            except Exception:
+                logging.warning("Mailbox watcher error: " + \
+                                str(sys.exc_info()[1]))
+                if agent is not None:
+                    try:
+                        agent.logout()
+                    except Exception:
+                        pass
+                self.stopping.wait(60)
+        logging.info("Stopped watching mailbox: " + self.mailbox)
+
+
+    def idle(self, agent):
+        """ Waits in IDLE state until a message arrives, the refresh delay
+        expires or the watcher is stopped. Only this thread uses the
+        connection, so the socket is polled every second rather than
+        written to by another thread while this one reads it. """
+
+        imap = agent.imap
+        tag = imap._new_tag()
+        imap.send(tag + b' IDLE' + imaplib.CRLF)
+        line = imap.readline()
+        if not line.startswith(b'+'):
+            del imap.tagged_commands[tag]
+            raise imaplib.IMAP4.error("IDLE refused: " + str(line))
+
+        deadline = time.time() + self.refresh
+        arrived = False
+        done = False
+        try:
+            while True:
+                if not done and (self.stopping.is_set() or arrived
+                                 or time.time() >= deadline):
+                    imap.send(b'DONE' + imaplib.CRLF)
+                    done = True
+                if not self.readable(imap.sock, 1):
+                    continue
+                line = imap.readline()
+                if not line or line.startswith(b'* BYE'):
+                    raise imaplib.IMAP4.abort("Connection closed during IDLE.")
+                if line.startswith(tag + b' '):
+                    break
+                if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                    logging.info("New message in mailbox: " + self.mailbox)
+                    self.arrived.set()
+                    arrived = True
+        finally:
+            del imap.tagged_commands[tag]
+        if not line.startswith(tag + b' OK'):
+            raise imaplib.IMAP4.error("IDLE failed: " + str(line))
+
+
+    def readable(self, sock, timeout):
+        """ Tells whether data can be read from given socket, waiting
+        for it at most timeout seconds. """
+
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            return True
+        readable, writable, failed = select.select([sock], [], [], timeout)
+        return len(readable) > 0
+
+
+    def stop(self):
+        """ Makes the watcher log out, within a second. """
+
+        self.stopping.set()
+
+
 
 class YAgent(object):       #pylint: disable-msg=R0904
     """ An IMAP4 agent that can manage RSS feeds as mailboxes. """
 
-    def __init__(self):
+    def __init__(self, parent=None):
 
         logging.info("-----------------------------------------------")
         logging.info("Initializing new agent.")
@@ -443,36 +1858,135 @@ class YAgent(object):       #pylint: disable-msg=R0904
             self.imap = imaplib.IMAP4_SSL(config.servername, config.port)
         except:
             self.imap = imaplib.IMAP4(config.servername, config.port)
+
+        # Local state kept between runs
+        if parent is None:
+            self.store = YStore()
+            self.scheduler = YScheduler(self.store)
+            self.renderer = YRenderer(self.store)
+        else:
+            self.store = parent.store
+            self.scheduler = parent.scheduler
+            self.renderer = parent.renderer
+
+        # Connections used to update feed mailboxes in parallel
+        self.pool = None
+
+        # When every mailbox was last searched for commands
+        self.lastFullScan = 0
+
+        # Selected mailbox, whether it was selected read-only and its
+        # UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ
+        self.selected = None
+        self.readonly = False
+        self.selectedState = {}
+
+        # Number of SELECT and EXAMINE commands sent or avoided
+        self.selectCounts = {'SELECT': 0, 'EXAMINE': 0, 'avoided': 0}
+        self.countLock = threading.Lock()
+
+        # Whether the server sends changes since a given HIGHESTMODSEQ
+        # (RFC 7162), and whether it also tells about expunged messages
+        self.condstore = False
+        self.qresync = False
+
+        # Parsed feeds fetched during the current update, by URL
+        self.feeds = {}
+
+        # Parsed feeds fetched during the current update before their
+        # command existed (when importing OPML), kept for the next update
+        self.nextFeeds = {}
+
+        # Names of mailboxes known to exist
+        self.knownMailboxes = set(['INBOX'])
+
+        # Statuses of mailboxes got by the current update, by name
+        self.mailboxStatuses = {}
+
+        # Whether commands of the INBOX created mailboxes or imported
+        # feeds, whose commands only an update of all mailboxes finds
+        self.treeChanged = False
+
+        # One semaphore per host, limiting simultaneous downloads
+        self.hostSemaphores = {}
+        self.hostLock = threading.Lock()
+        if parent is not None:
+            self.feeds = parent.feeds
+            self.nextFeeds = parent.nextFeeds
+            self.knownMailboxes = parent.knownMailboxes
+            self.mailboxStatuses = parent.mailboxStatuses
+            self.selectCounts = parent.selectCounts
+            self.countLock = parent.countLock
+            self.hostSemaphores = parent.hostSemaphores
+            self.hostLock = parent.hostLock
         logging.info("New agent initialized.")
 
 
+    def spawn(self):
+        """ Returns a new logged in agent with its own IMAP connection,
+        sharing the state of this agent. """
+
+        agent = YAgent(parent=self)
+        status = agent.login()
+        if status != 'OK':
+            raise imaplib.IMAP4.error("Could not log in a new agent.")
+        return agent
+
+
     def login(self):
         """ Logs in using credentials given in config file. """
 
         logging.info("Logging in.")
         status, message = self.imap.login(config.username,
                                           config.password)
+        if status != 'OK':
+            return status
+
+        # Capabilities may change once authenticated
+        typ, data = self.imap.capability()
+        if typ == 'OK' and data[-1] is not None:
+            self.imap.capabilities = tuple(data[-1].decode().upper().split())
+        if 'ENABLE' in self.imap.capabilities:
+            for extension in ['QRESYNC', 'CONDSTORE']:
+                if extension not in self.imap.capabilities:
+                    continue
+                typ, data = self.imap.enable(extension)
+                if typ == 'OK':
+                    logging.info("Enabled IMAP extension: " + extension)
+                    self.condstore = True
+                    self.qresync = extension == 'QRESYNC'
+                    break
         return status
 
 
-    def select(self, mailbox='INBOX.' + config.mailbox):
-        """ Selects given mailbox or mailbox given in config gile. """
+    def select(self, mailbox='INBOX.' + config.mailbox, readonly=False):
+        """ Selects given mailbox or mailbox given in config gile, unless
+        it is already selected. When readonly, the mailbox is examined
+        instead, which is enough for searching and fetching. """
 
+        mbox = quoteMailbox(mailbox)
+        if mbox == self.selected and (readonly or not self.readonly):
+            self.countSelect('avoided')
+            return 'OK'
         logging.info("Selecting mailbox: " + mailbox)
-        mbox = mailbox
-        if mbox[0] != '"':
-            mbox = '"' + mbox + '"'
-        status, message = self.imap.select(mbox)
+        self.selected = None
+        status, message = self.imap.select(mbox, readonly=readonly)
+        self.countSelect('EXAMINE' if readonly else 'SELECT')
         if status == 'NO': # there's no such mailbox, let's create one
+            readonly = False
             self.imap.select()
             status, message = self.imap.create(mbox)
             if status != "OK":
                 logging.error("Could not create mailbox: " + str(mbox))
             self.imap.subscribe(mbox)
             status, message = self.imap.select(mbox)
+            self.countSelect('SELECT', 2)
             if status != "OK":
                 logging.error("Could not select mailbox: " + str(mbox))
-            if mbox in ['"INBOX.testyarss2imap"', '"INBOX.' + config.mailbox + '"']:
+            else:
+                self.knownMailboxes.add(unquoteMailbox(mbox))
+            if unquoteMailbox(mbox) in ['INBOX.testyarss2imap',
+                                        'INBOX.' + config.mailbox]:
                 # The default yarss2imap mailbox was just created
                 # Let's populate it with a README message.
                 logging.info("Creating README message")
@@ -502,22 +2016,50 @@ class YAgent(object):       #pylint: disable-msg=R0904
                                     text)
                 if status != 'OK':
                     logging.error('Could not append README message: ' + error)
-                self.imap.select(mbox)
-
+                status, message = self.imap.select(mbox)
+                self.countSelect('SELECT')
+
+        # Remember what the server told about the selected mailbox
+        self.selectedState = {}
+        if status == 'OK':
+            self.selected = mbox
+            self.readonly = readonly
+            for name in ['UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ']:
+                value = self.imap.untagged_responses.get(name, [None])[-1]
+                if value is not None:
+                    self.selectedState[name] = int(value)
 
         return status
 
 
+    def countSelect(self, kind, count=1):
+        """ Counts SELECT or EXAMINE commands, sent or avoided. """
+
+        with self.countLock:
+            self.selectCounts[kind] += count
+
+
+    def forgetSelection(self):
+        """ Makes next select actually select, so that the state of the
+        mailbox is refreshed. """
+
+        self.selected = None
+
+
     def close(self):
 
         logging.info("Closing connexion.")
+        self.selected = None
         status, message = self.imap.close()
         return status
 
 
     def logout(self):
 
+        if self.pool is not None:
+            self.pool.close()
         logging.info("Logging out.")
+        self.selected = None
         status, message = self.imap.logout()
         return status
 
@@ -528,17 +2070,15 @@ class YAgent(object):       #pylint: disable-msg=R0904
         if mailbox is None:
             return None
         logging.info("Erasing mailbox: " + mailbox)
+        name = unquoteMailbox(mailbox)
+        mailbox = quoteMailbox(mailbox)
         lines = self.imap.list(mailbox)[1]
         self.select(mailbox='INBOX')
-        for line in lines:
-            if line is None:
-                continue
-            line = line.decode()
-            path = re.search(r'\(.*\) ".*" "(.*)"', line).groups()[0]
-            if path[0] != '"':
-                path = '"' + path + '"'
-            if path in [mailbox, '"' + mailbox + '"']:
+        for line in joinLiterals(lines):
+            flags, path = parseList(line)
+            if path is None or path == name:
                 continue # we'll remove it at the end
+            path = quoteMailbox(path)
             status, message = self.imap.unsubscribe(path)
             if status != 'OK':
                 logging.error("Could not unsubscribe from: " + path)
@@ -546,32 +2086,335 @@ class YAgent(object):       #pylint: disable-msg=R0904
             if status != 'OK':
                 logging.error("Could not delete path: " + path)
         self.imap.unsubscribe(mailbox)
+        for knownMailbox in list(self.knownMailboxes):
+            if knownMailbox == name or knownMailbox.startswith(name + '.'):
+                self.knownMailboxes.discard(knownMailbox)
         return self.imap.delete(mailbox)[0]
 
 
     def moveUID(self, uid, fromMailbox='INBOX', toMailbox='INBOX'):
         """ Moves message given by UID from one mailbox to another. """
 
-        fromMb = fromMailbox
-        if fromMb[0] != '"':
-            fromMb = '"' + fromMb + '"' # make it safe
-        toMb = toMailbox
-        if toMb[0] != '"':
-            toMb = '"' + toMb + '"' # make it safe
+        fromMb = quoteMailbox(fromMailbox)
+        toMb = quoteMailbox(toMailbox)
         if fromMb == toMb:
             return
         logging.info("Moving message from " + fromMb + " to " + toMb)
         status = self.select(fromMb)
         if status != 'OK':
             logging.error("Could not select mailbox: " + fromMb)
+        if 'MOVE' in self.imap.capabilities:
+            # RFC 6851
+            status, msg = self.imap.uid('move', uid, toMb)
+            if status != 'OK':
+                logging.error("Could not move a message to mailbox: " + toMb)
+                logging.error("   error message was: " + str(msg))
+            return
         status, msg = self.imap.uid('copy', uid, toMb)
         if status != 'OK':
             logging.error("Could not copy a message to mailbox: " + toMb)
             logging.error("   error message was: " + str(msg))
+            return
         status, msg = self.imap.uid('store', uid, '+FLAGS', '\\Deleted')
         if status != 'OK':
             logging.error("Could not delete message with UID: " + uid)
             logging.error("   error message was: " + str(msg))
+        self.expungeUID(uid)
+
+
+    def expungeUID(self, uid):
+        """ Permanently removes the message with given UID from the
+        selected mailbox if it is flagged as deleted. Other deleted
+        messages are left alone, which requires the UIDPLUS extension
+        (RFC 4315) : without it, nothing is expunged. """
+
+        if 'UIDPLUS' not in self.imap.capabilities:
+            return 'OK'
+        status, msg = self.imap.uid('expunge', uid)
+        if status != 'OK':
+            logging.error("Could not expunge message with UID: " + uid)
+            logging.error("   error message was: " + str(msg))
+        return status
+
+
+    def pipeline(self, commands):
+        """ Sends given (command name, arguments) pairs to the server at
+        once, then waits for their responses. Arguments are bytes which
+        must not require any synchronizing literal. Returns one (status,
+        data) pair per command. """
+
+        tags = []
+        for name, arguments in commands:
+            tag = self.imap._new_tag()
+            # ^-- registers the tag so that imaplib accepts its response
+            self.imap.send(tag + b' ' + name.encode() + b' ' + \
+                           arguments + imaplib.CRLF)
+            tags.append((name, tag))
+        results = []
+        for name, tag in tags:
+            try:
+                results.append(self.imap._command_complete(name, tag))
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                results.append(('BAD', [str(sys.exc_info()[1]).encode()]))
+        return results
+
+
+    def appendMessages(self, mailbox, messages):
+        """ Appends given messages to given mailbox and returns one
+        (status, data) pair per message. Messages are sent by batches of
+        APPEND_BATCH, as a single MULTIAPPEND command (RFC 3502) or as
+        pipelined APPEND commands when the server accepts non-synchronizing
+        literals (RFC 7888), one at a time otherwise. """
+
+        if len(messages) == 0:
+            return []
+        mbox = quoteMailbox(mailbox)
+        date = imaplib.Time2Internaldate(time.time())
+        messages = [imaplib.MapCRLF.sub(imaplib.CRLF, msg) for msg in messages]
+        canPipeline = 'LITERAL+' in self.imap.capabilities
+        canMultiAppend = canPipeline and \
+                         'MULTIAPPEND' in self.imap.capabilities
+
+        started = time.time()
+        results = []
+        for first in range(0, len(messages), APPEND_BATCH):
+            batch = messages[first:first + APPEND_BATCH]
+            batchResults = None
+            if canMultiAppend and len(batch) > 1:
+                arguments = mbox.encode() + b' ' + \
+                            b' '.join(appendLiteral(date, msg)
+                                      for msg in batch)
+                status, data = self.pipeline([('APPEND', arguments)])[0]
+                if status == 'OK':
+                    batchResults = [(status, data)] * len(batch)
+                else:
+                    # Nothing was appended, let's find out which one failed
+                    logging.warning("Could not append " + \
+                                    str(len(batch)) + " messages at once: " + \
+                                    str(data))
+            if batchResults is None and canPipeline:
+                batchResults = self.pipeline(
+                        [('APPEND', mbox.encode() + b' ' + \
+                                    appendLiteral(date, msg))
+                         for msg in batch])
+            elif batchResults is None:
+                batchResults = [self.imap.append(mbox, '', date, msg)
+                                for msg in batch]
+            results += batchResults
+
+        for index, (status, data) in enumerate(results):
+            if status != 'OK':
+                logging.error("Could not append message " + \
+                              str(index + 1) + "/" + str(len(results)) + \
+                              " to mailbox " + mbox + ": " + str(data))
+        duration = max(time.time() - started, 0.001)
+        logging.info("Appended " + str(len(messages)) + \
+                     " messages to mailbox " + mbox + " at " + \
+                     "%.1f" % (len(messages) / duration) + \
+                     " messages/second.")
+        return results
+
+
+    def appendEach(self, messages):
+        """ Appends (mailbox, message) pairs and returns one (status,
+        data) pair per message. APPEND commands are pipelined by batches of
+        APPEND_BATCH when the server accepts non-synchronizing literals
+        (RFC 7888), sent one at a time otherwise. """
+
+        date = imaplib.Time2Internaldate(time.time())
+        canPipeline = 'LITERAL+' in self.imap.capabilities
+        results = []
+        for first in range(0, len(messages), APPEND_BATCH):
+            batch = []
+            for mailbox, msg in messages[first:first + APPEND_BATCH]:
+                batch.append((quoteMailbox(mailbox),
+                              imaplib.MapCRLF.sub(imaplib.CRLF, msg)))
+            if canPipeline:
+                results += self.pipeline(
+                        [('APPEND', mailbox.encode() + b' ' + \
+                                    appendLiteral(date, msg))
+                         for mailbox, msg in batch])
+            else:
+                results += [self.imap.append(mailbox, '', date, msg)
+                            for mailbox, msg in batch]
+            logging.info("Appended " + str(len(results)) + "/" + \
+                         str(len(messages)) + " messages.")
+        return results
+
+
+    def createMailboxes(self, mailboxes):
+        """ Creates and subscribes to the given mailboxes, unless they are
+        known to exist. CREATE and SUBSCRIBE commands are pipelined by
+        batches of MAILBOX_BATCH. """
+
+        missing = []
+        for mailbox in mailboxes:
+            name = unquoteMailbox(mailbox)
+            if name not in self.knownMailboxes and name not in missing:
+                missing.append(name)
+        for first in range(0, len(missing), MAILBOX_BATCH):
+            batch = missing[first:first + MAILBOX_BATCH]
+            commands = []
+            for name in batch:
+                commands += [('CREATE', quoteMailbox(name).encode()),
+                             ('SUBSCRIBE', quoteMailbox(name).encode())]
+            results = self.pipeline(commands)
+            for (command, quoted), (status, data) in \
+                zip(commands, results):
+                if status != 'OK':
+                    # CREATE fails when the mailbox already exists
+                    logging.info("Could not " + command + " mailbox: " + \
+                                 quoted.decode() + ": " + str(data))
+                if command == 'CREATE' and \
+                   (status == 'OK' or b'[ALREADYEXISTS]' in b' '.join(
+                        item for item in data if isinstance(item, bytes))):
+                    self.knownMailboxes.add(unquoteMailbox(quoted.decode()))
+            logging.info("Created " + str(first + len(batch)) + "/" + \
+                         str(len(missing)) + " mailboxes.")
+
+
+    def fetchEntryKeys(self, uids='1:*'):
+        """ Returns the entry keys of undeleted messages with given UIDs in
+        the selected mailbox, by UID, using a single FETCH command. The key
+        of a message is its Message-ID when yarss2imap gave it one, else
+        the entry link given by its X-Entry-Link header. Returns None if
+        messages could not be fetched. """
+
+        status, data = self.imap.uid(
+                'fetch',
+                uids,
+                '(FLAGS BODY.PEEK[HEADER.FIELDS (MESSAGE-ID X-ENTRY-LINK)])')
+        if status != 'OK':
+            logging.error("Could not fetch Message-ID headers.")
+            logging.error("   error message was: " + str(data))
+            return None
+        keys = {}
+        for description, literals in parseFetch(data):
+            uid = fetchedUID(description)
+            if uid is None or '\\Deleted' in fetchedFlags(description):
+                continue
+            for literal in literals:
+                headers = email.message_from_bytes(literal)
+                messageId = headers['Message-ID']
+                if messageId is not None and \
+                    messageId.strip().endswith('@' + MESSAGE_ID_DOMAIN + '>'):
+                    keys[int(uid)] = messageId.strip()
+                    continue
+                header = headers['X-Entry-Link']
+                if header is None:
+                    continue
+                keys[int(uid)] = \
+                    str(email.header.make_header(
+                            email.header.decode_header(header)))
+        logging.info("Fetched " + str(len(keys)) + " entry keys.")
+        return keys
+
+
+    def deliveredEntries(self, mailbox):
+        """ Returns the set of entry keys already delivered to the given
+        mailbox, which must be the selected one. Keys are read from the
+        local index, which is trusted as long as the UIDVALIDITY of the
+        mailbox does not change. Only messages appended since the last
+        update, and messages changed or expunged since then when the
+        server supports CONDSTORE, are fetched from the server. Returns
+        None if messages could not be fetched. """
+
+        uidvalidity = self.selectedState.get('UIDVALIDITY')
+        uidnext = self.selectedState.get('UIDNEXT')
+        highestModSeq = self.selectedState.get('HIGHESTMODSEQ')
+        if uidvalidity is None:
+            # Without UIDVALIDITY, the index can't be trusted.
+            keys = self.fetchEntryKeys()
+            if keys is None:
+                return None
+            return set(keys.values())
+
+        indexedValidity, indexedNext, indexedModSeq = \
+            self.store.mailboxIndex(mailbox)
+        if indexedValidity != uidvalidity:
+            logging.info("Indexing entries of mailbox: " + mailbox)
+            keys = self.fetchEntryKeys()
+            if keys is None:
+                return None
+            self.store.resetEntries(mailbox, uidvalidity)
+            indexedModSeq = None
+        elif indexedNext is None or uidnext is None \
+            or uidnext > indexedNext:
+            firstUID = indexedNext or 1
+            keys = self.fetchEntryKeys(str(firstUID) + ':*')
+            if keys is None:
+                return None
+            # n:* always includes the last message, even if its UID is < n
+            keys = dict((uid, key) for uid, key in keys.items()
+                         if uid >= firstUID)
+        else:
+            keys = {}
+        self.store.addEntries(mailbox, keys.items())
+
+        if self.condstore and indexedModSeq is not None \
+            and highestModSeq is not None and highestModSeq > indexedModSeq:
+            if not self.resync(mailbox, indexedModSeq):
+                return None
+        self.store.setMailboxIndex(mailbox, uidnext, highestModSeq)
+        return self.store.entryKeys(mailbox)
+
+
+    def resync(self, mailbox, modSeq):
+        """ Updates the local index of the given mailbox, which must be the
+        selected one, with messages changed or expunged since the given
+        modification sequence (RFC 7162). Returns False if changes could
+        not be fetched. """
+
+        logging.info("Resynchronizing mailbox: " + mailbox)
+        modifiers = '(CHANGEDSINCE ' + str(modSeq)
+        if self.qresync:
+            modifiers += ' VANISHED'
+        status, data = self.imap.uid('fetch', '1:*', '(FLAGS)',
+                                     modifiers + ')')
+        if status != 'OK':
+            logging.error("Could not fetch changes in mailbox: " + mailbox)
+            logging.error("   error message was: " + str(data))
+            return False
+        removed = []
+        changed = []
+        for description, literals in parseFetch(data):
+            uid = fetchedUID(description)
+            if uid is None:
+                # Unsolicited FETCH responses may have no UID
+                continue
+            if '\\Deleted' in fetchedFlags(description):
+                removed.append(int(uid))
+            else:
+                changed.append(int(uid))
+
+        indexedUIDs = self.store.indexedUIDs(mailbox)
+        if self.qresync:
+            typ, vanished = self.imap.response('VANISHED')
+            for line in vanished:
+                if line is not None:
+                    removed += uidSet(line.decode().split()[-1])
+        else:
+            # Expunged messages are the indexed ones not found anymore
+            status, data = self.imap.uid('search', None, 'ALL')
+            if status != 'OK':
+                logging.error("Could not search mailbox: " + mailbox)
+                return False
+            found = set(int(uid) for uid in data[0].split())
+            removed += [uid for uid in indexedUIDs if uid not in found]
+        self.store.removeEntries(mailbox, removed)
+
+        # Messages which were undeleted must be indexed again
+        missing = [uid for uid in changed if uid not in indexedUIDs]
+        if missing:
+            keys = self.fetchEntryKeys(','.join(str(uid) for uid in missing))
+            if keys is None:
+                return False
+            self.store.addEntries(mailbox, keys.items())
+        logging.info("Found " + str(len(changed) + len(removed)) + \
+                     " changed messages in mailbox: " + mailbox)
+        return True
 
 
     def listMailboxes(self, mailbox='INBOX' + config.mailbox, pattern='*'):
@@ -579,42 +2422,76 @@ class YAgent(object):       #pylint: disable-msg=R0904
         given pattern. """
 
         mailboxNames = []
-        mailboxes = self.imap.list(mailbox, pattern=pattern)[1]
-        for mailboxFound in mailboxes:
-            if mailboxFound is not None:
-                mailboxName = re.search(r'\(.*\) ".*" "(.*)"',
-                                        mailboxFound.decode()).groups()[0]
+        mailboxes = self.imap.list(quoteMailbox(mailbox), pattern=pattern)[1]
+        for mailboxFound in joinLiterals(mailboxes):
+            flags, mailboxName = parseList(mailboxFound)
+            if mailboxName is not None:
                 mailboxNames.append(mailboxName)
         return mailboxNames
 
 
-    def listCommands(self, mailbox='INBOX' + config.mailbox):
-        """ Returns a list of command messages found in the given mailbox. """
+    def listCommands(self, mailbox='INBOX' + config.mailbox, uids=None):
+        """ Returns a list of command messages found in the given mailbox,
+        among messages with given UIDs if any, or None if the mailbox
+        could not be searched. Only the headers of command messages are
+        downloaded, except for OPML imports which need their
+        attachment. """
 
         logging.info("Looking for command messages in: " + mailbox)
-        self.select(mailbox)
-        self.imap.recent()
+        # Commands in the INBOX get moved, others are only read
+        self.select(mailbox, readonly=unquoteMailbox(mailbox) != 'INBOX')
         commandMessages = []
 
-        commandPattern = {
-                'feed': 'HEADER Subject "feed "',
-                'importOPML': 'HEADER Subject "importOPML"'
+        commandSubjects = {
+                'feed': 'feed ',
+                'importOPML': 'importOPML'
                 }
 
-        for command, pattern in commandPattern.items():
+        status, data = self.imap.uid(
+                'search',
+                None,
+                ('UID ' + uids + ' ' if uids is not None else '') + \
+                'UNDELETED OR ' + \
+                ' '.join('HEADER Subject "' + subject + '"'
+                         for subject in commandSubjects.values()))
+        if status != 'OK':
+            logging.error("Could not search for command messages in: " + \
+                          mailbox)
+            return None
+        if data[0] is None:
+            return commandMessages
+        messageUIDs = data[0].decode().split()
+        if len(messageUIDs) == 0:
+            return commandMessages
+        status, data = self.imap.uid(
+                'fetch',
+                ','.join(messageUIDs),
+                '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)])')
+        if status != 'OK':
+            logging.error("Could not fetch command messages in: " + mailbox)
+            return None
 
-            status, data = self.imap.uid('search', None, 'UNDELETED ' + pattern)
-            messageUIDs = data[0].decode().split()
+        messagesByCommand = dict((command, []) for command in commandSubjects)
+        for description, literals in parseFetch(data):
+            if len(literals) == 0:
+                continue
+            uid = fetchedUID(description)
+            msg = email.message_from_bytes(literals[0])
+            subject = str(msg['Subject']).lower()
+            for command, commandSubject in commandSubjects.items():
+                # IMAP searches are case-insensitive
+                if commandSubject.lower() in subject:
+                    messagesByCommand[command].append((uid, msg))
+
+        for command, messages in messagesByCommand.items():
             logging.info("Found " + \
-                         str(len(messageUIDs)) + \
+                         str(len(messages)) + \
                          " command messages of type '" + \
                          command + \
                          "' in mailbox: " + \
                          mailbox)
 
-            for uid in messageUIDs:
-                msgBin = self.imap.uid('fetch', uid, '(RFC822)')[1][0][1]
-                msg = email.message_from_bytes(msgBin)
+            for uid, msg in messages:
                 if command == "feed":
                     commandMessage = YFeedCommandMessage(message=msg,
                                                          mailbox=mailbox,
@@ -624,6 +2501,17 @@ class YAgent(object):       #pylint: disable-msg=R0904
                         # invalid command : no URL
                         commandMessage = None
                 elif command == "importOPML":
+                    # The OPML document is needed, let's get all of it
+                    status, data = self.imap.uid('fetch', uid,
+                                                 '(BODY.PEEK[])')
+                    responses = []
+                    if status == 'OK':
+                        responses = parseFetch(data)
+                    if len(responses) == 0 or len(responses[0][1]) == 0:
+                        logging.error("Could not fetch message with UID: " + \
+                                      uid)
+                        return None
+                    msg = email.message_from_bytes(responses[0][1][0])
                     commandMessage = YImportCommandMessage(message=msg,
                                                            mailbox=mailbox,
                                                            messageUID=uid,
@@ -637,6 +2525,118 @@ class YAgent(object):       #pylint: disable-msg=R0904
         return commandMessages
 
 
+    def fetch(self, url, conditional=True):
+        """ Downloads and parses the feed at the given URL. No more than
+        FETCH_PER_HOST feeds are downloaded from the same host at once,
+        and a download is given up after FETCH_TIMEOUT seconds without
+        an answer, which counts as a failure of the feed.
+        Unless told otherwise, the request is conditional when validators
+        (ETag, Last-Modified) are known for this URL : the result then
+        has a 304 status if the feed did not change. """
+
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self.hostLock:
+            if host not in self.hostSemaphores:
+                self.hostSemaphores[host] = \
+                    threading.BoundedSemaphore(FETCH_PER_HOST)
+            semaphore = self.hostSemaphores[host]
+        etag, modified, title = self.store.validators(url)
+        if not conditional:
+            etag, modified = None, None
+        with semaphore:
+            return feedparser.parse(url, etag=etag, modified=modified,
+                                    handlers=[YTimeoutHandler()])
+
+
+    def cachedFeed(self, url):
+        """ Returns the parsed feed at the given URL, downloaded unless it
+        already was during this update or since the last one. Feeds
+        downloaded that way are kept for the next update. """
+
+        parsed = self.feeds.get(url) or self.nextFeeds.get(url)
+        if parsed is None:
+            parsed = self.fetch(url)
+            self.feeds[url] = parsed
+            self.nextFeeds[url] = parsed
+        return parsed
+
+
+    def feedUpdated(self, feed):
+        """ Remembers the validators of a feed whose entries were all
+        delivered, so that next fetch is conditional. """
+
+        if feed.url is None or feed.feed is None:
+            return
+        # Redirected feeds have validators too, feeds without entries
+        # may be transient errors
+        status = feed.feed.get('status')
+        if status is None or not 200 <= status < 400 \
+            or len(feed.feed.entries) == 0:
+            return
+        self.store.setValidators(feed.url,
+                                 etag=feed.feed.get('etag'),
+                                 modified=feed.feed.get('modified'),
+                                 title=feed.title())
+
+
+    def fetchFeeds(self, urls):
+        """ Downloads and parses the feeds at the given URLs using a pool
+        of FETCH_WORKERS threads, unless they are already in self.feeds.
+        Usable feeds are stored in self.feeds. Returns the URLs of the
+        feeds suspended by this failure. """
+
+        # Feeds downloaded by the previous update for these URLs
+        urls = set(urls)
+        outcomes = [(url, self.feeds.pop(url), None)
+                    for url in sorted(urls) if url in self.feeds]
+
+        # Interleave hosts so that workers waiting for a busy host
+        # do not hold up the rest of the pool.
+        fetched = set(url for url, parsed, error in outcomes)
+        urlsByHost = {}
+        for url in sorted(urls - fetched):
+            host = urllib.parse.urlsplit(url).netloc.lower()
+            urlsByHost.setdefault(host, []).append(url)
+        queues = list(urlsByHost.values())
+        orderedURLs = []
+        while queues:
+            orderedURLs += [queue.pop(0) for queue in queues]
+            queues = [queue for queue in queues if queue]
+
+        logging.info("Fetching " + str(len(orderedURLs)) + " feeds from " + \
+                     str(len(urlsByHost)) + " hosts, " + \
+                     str(len(outcomes)) + " feeds were already fetched.")
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=FETCH_WORKERS) as executor:
+            futures = {executor.submit(self.fetch, url): url
+                       for url in orderedURLs}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    outcomes.append((futures[future], future.result(), None))
+                except Exception:
+                    outcomes.append((futures[future], None,
+                                     str(sys.exc_info()[1])))
+        logging.info("Fetched " + str(len(orderedURLs)) + " feeds in " + \
+                     "%.1f" % (time.time() - started) + " seconds.")
+
+        suspended = []
+        for url, parsed, error in outcomes:
+            headers = None
+            if parsed is not None:
+                error = feedError(parsed)
+                headers = parsed.get('headers')
+            if error is None:
+                self.feeds[url] = parsed
+                self.scheduler.fetched(url, parsed)
+                continue
+            logging.error("Could not fetch feed from URL: " + url)
+            logging.error("    error was: " + error)
+            if self.scheduler.failed(url, error, retryAfter(headers)):
+                suspended.append(url)
+        return suspended
+
+
     def update(self, mailbox='INBOX.' + config.mailbox):
         """ Looks for command messages in the INBOX and under the given
         mailbox. Then executes these commands. Commands are given
@@ -646,22 +2646,263 @@ class YAgent(object):       #pylint: disable-msg=R0904
 
         logging.info("Updating mailbox: " + mailbox)
 
+        self.startCycle()
+
         # Did we receive any new command message in the INBOX
         # or in the given mailbox ?
         listedMailboxes = ['INBOX', mailbox]
         # Or are there older command messages already stored under
         # their own folders ?
-        listedMailboxes += self.listMailboxes(mailbox)
+        snapshot = self.snapshot(mailbox)
+        listedMailboxes += list(snapshot.keys())
+        self.knownMailboxes.clear()
+        self.knownMailboxes.update(['INBOX'] + list(snapshot.keys()))
+        self.mailboxStatuses.clear()
+        self.mailboxStatuses.update(snapshot)
 
         # Search for such messages and their command line in those mailboxes
-        commands = []
-        for listedMailbox in listedMailboxes:
-            commands += self.listCommands(listedMailbox)
+        commands = self.discoverCommands(listedMailboxes, snapshot)
+        self.scheduler.keep([command.feedURL for command in commands
+                             if isinstance(command, YFeedCommandMessage)])
 
         logging.info("Found " + \
                      str(len(commands)) + \
                      " command messages under mailbox: " + \
                      mailbox)
+        # Feeds downloaded by imports since last update are used now
+        self.feeds.clear()
+        self.feeds.update(self.nextFeeds)
+        self.nextFeeds.clear()
+        result = self.executeCommands(commands, mailbox)
+        logging.info("Sent " + str(self.selectCounts['SELECT']) + \
+                     " SELECT and " + str(self.selectCounts['EXAMINE']) + \
+                     " EXAMINE commands, avoided " + \
+                     str(self.selectCounts['avoided']) + ".")
+        return result
+
+
+    def statusItems(self):
+        """ Returns the STATUS items describing the state of a mailbox. """
+
+        items = 'MESSAGES UIDNEXT UIDVALIDITY'
+        if self.condstore:
+            items += ' HIGHESTMODSEQ'
+        return items
+
+
+    def uidValidity(self, mailbox):
+        """ Returns the current UIDVALIDITY of the given mailbox, which
+        comes from the statuses got by the current update or else is asked
+        for, or None if it is not known. """
+
+        name = unquoteMailbox(mailbox)
+        status = self.mailboxStatuses.get(name)
+        if status is None:
+            status = self.mailboxStatus([name]).get(name)
+        if status is None:
+            return None
+        return status.get('UIDVALIDITY')
+
+
+    def indexed(self, mailbox):
+        """ Tells whether the entries of the given mailbox are indexed
+        for its current UIDVALIDITY. A new or recreated mailbox is not
+        indexed. """
+
+        uidvalidity = self.uidValidity(mailbox)
+        if uidvalidity is None:
+            return False
+        return self.store.mailboxIndex(mailbox)[0] == uidvalidity
+
+
+    def mailboxStatus(self, mailboxes):
+        """ Returns the status (MESSAGES, UIDNEXT, UIDVALIDITY and, with
+        CONDSTORE, HIGHESTMODSEQ) of given mailboxes, by mailbox name.
+        STATUS commands are pipelined. """
+
+        items = self.statusItems()
+        statuses = {}
+        for first in range(0, len(mailboxes), STATUS_BATCH):
+            batch = mailboxes[first:first + STATUS_BATCH]
+            results = self.pipeline(
+                    [('STATUS', (quoteMailbox(mailbox) + ' (' + \
+                                 items + ')').encode())
+                     for mailbox in batch])
+            for mailbox, (status, data) in zip(batch, results):
+                if status != 'OK':
+                    logging.error("Could not get status of mailbox: " + \
+                                  mailbox)
+            typ, lines = self.imap.response('STATUS')
+            for line in joinLiterals(lines):
+                name, status = parseStatus(line)
+                if name is not None:
+                    statuses[name] = status
+        return statuses
+
+
+    def snapshot(self, mailbox='INBOX.' + config.mailbox, pattern='*'):
+        """ Returns the status of every selectable mailbox under given
+        mailbox and with a name matching given pattern, by mailbox name.
+        This takes a single LIST command when the server supports
+        LIST-STATUS (RFC 5819), a LIST then pipelined STATUS commands
+        otherwise. """
+
+        listStatus = 'LIST-STATUS' in self.imap.capabilities
+        if listStatus:
+            typ, data = self.imap._simple_command(
+                    'LIST', quoteMailbox(mailbox), pattern,
+                    'RETURN', '(STATUS (' + self.statusItems() + '))')
+            typ, lines = self.imap._untagged_response(typ, data, 'LIST')
+        else:
+            typ, lines = self.imap.list(quoteMailbox(mailbox), pattern)
+        if typ != 'OK':
+            logging.error("Could not list mailboxes under: " + mailbox)
+            return {}
+
+        names = []
+        for line in joinLiterals(lines):
+            flags, name = parseList(line)
+            if name is not None and '\\NOSELECT' not in \
+                [flag.upper() for flag in flags]:
+                names.append(name)
+        if listStatus:
+            statuses = {}
+            typ, lines = self.imap.response('STATUS')
+            for line in joinLiterals(lines):
+                name, status = parseStatus(line)
+                statuses[name] = status
+        else:
+            statuses = self.mailboxStatus(names)
+        snapshot = dict((name, statuses[name]) for name in names
+                        if name in statuses)
+        logging.info("Got the status of " + str(len(snapshot)) + \
+                     " mailboxes under: " + mailbox)
+        return snapshot
+
+
+    def discoverCommands(self, mailboxes, statuses=None):
+        """ Returns the command messages found in given mailboxes. Mailboxes
+        are searched only if their status changed since they were last
+        searched, and only among messages appended since then if no
+        message went away. Feed commands of other mailboxes come from
+        the command registry. The INBOX is always searched, and so is
+        every mailbox once every COMMAND_RESCAN_INTERVAL seconds.
+        Statuses which are not given, by mailbox name, are asked
+        for. """
+
+        names = []
+        for mailbox in mailboxes:
+            if unquoteMailbox(mailbox) not in names:
+                names.append(unquoteMailbox(mailbox))
+        fullScan = time.time() - self.lastFullScan > COMMAND_RESCAN_INTERVAL
+        if fullScan:
+            logging.info("Searching every mailbox for commands.")
+            self.lastFullScan = time.time()
+        statuses = dict(statuses or {})
+        statuses.update(self.mailboxStatus(
+                [name for name in names
+                 if name != 'INBOX' and name not in statuses]))
+        commands = []
+        searched = 0
+        for name in names:
+            status = statuses.get(name)
+            if name == 'INBOX' or status is None:
+                found = self.listCommands(name)
+                searched += 1
+                if found is None:
+                    # The mailbox could not be searched, its registered
+                    # commands are still executed
+                    found = [YFeedCommandMessage(mailbox=name,
+                                                 messageUID=uid,
+                                                 agent=self,
+                                                 feedURL=url)
+                             for uid, url in self.store.registeredCommands(name)]
+                commands += found
+                continue
+            scanned = self.store.scannedStatus(name)
+            registered = self.store.registeredCommands(name)
+            if not fullScan and scanned == status:
+                found = []
+            elif not fullScan and scanned is not None \
+                and scanned['UIDVALIDITY'] == status['UIDVALIDITY'] \
+                and status['MESSAGES'] - scanned['MESSAGES'] == \
+                    status['UIDNEXT'] - scanned['UIDNEXT']:
+                # Messages were only added, let's search them
+                found = self.listCommands(
+                        name, uids=str(scanned['UIDNEXT']) + ':*')
+                searched += 1
+                if found is not None:
+                    found = [command for command in found
+                             if int(command.messageUID) >= scanned['UIDNEXT']]
+                if found is not None and registered:
+                    # and check registered commands were not deleted
+                    typ, data = self.imap.uid(
+                            'search', None,
+                            'UID ' + ','.join(uid for uid, url in registered) + \
+                            ' UNDELETED')
+                    if typ == 'OK':
+                        remaining = data[0].decode().split()
+                        registered = [(uid, url) for uid, url in registered
+                                      if uid in remaining]
+            else:
+                found = self.listCommands(name)
+                if found is not None:
+                    registered = []
+                searched += 1
+            commands += found or []
+            commands += [YFeedCommandMessage(mailbox=name,
+                                             messageUID=uid,
+                                             agent=self,
+                                             feedURL=url)
+                         for uid, url in registered]
+            if found is None:
+                # The mailbox could not be searched, its registered
+                # commands are kept and it is searched again next time
+                continue
+            self.store.registerCommands(
+                    name, status,
+                    registered + [(command.messageUID, command.feedURL)
+                                  for command in found
+                                  if isinstance(command, YFeedCommandMessage)])
+        self.store.forgetMailboxesExcept(names)
+        logging.info("Searched " + str(searched) + " of " + \
+                     str(len(names)) + " mailboxes for commands.")
+        return commands
+
+
+    def updateInbox(self, mailbox='INBOX.' + config.mailbox):
+        """ Executes the command messages found in the INBOX only. Feeds
+        get their mailbox under the given mailbox. """
+
+        logging.info("Updating mailbox INBOX.")
+        self.startCycle()
+        self.feeds.clear()
+        self.mailboxStatuses.clear()
+        commands = self.listCommands('INBOX') or []
+        known = set(self.knownMailboxes)
+        result = self.executeCommands(commands, mailbox)
+        self.treeChanged = not self.knownMailboxes <= known \
+            or any(isinstance(command, YImportCommandMessage)
+                   for command in commands)
+        return result
+
+
+    def startCycle(self):
+        """ Makes every connection select mailboxes again, so that their
+        new state is known, and resets the SELECT counts. """
+
+        self.forgetSelection()
+        if self.pool is not None:
+            with self.pool.lock:
+                for agent, created in self.pool.idle:
+                    agent.forgetSelection()
+        with self.countLock:
+            for kind in self.selectCounts:
+                self.selectCounts[kind] = 0
+
+
+    def executeCommands(self, commands, mailbox='INBOX.' + config.mailbox):
+        """ Executes given command messages once duplicates are removed. """
 
         # Remove duplicate command messages
         opmls = {}
@@ -699,26 +2940,131 @@ class YAgent(object):       #pylint: disable-msg=R0904
                      str(len(uniqueCommands)) + \
                      " unique commands under mailbox: " + \
                      mailbox)
+
+        # Feeds are only updated when they are due, unless their command
+        # just arrived in the INBOX
+        now = time.time()
+        notDue = [command for command in uniqueCommands
+                  if isinstance(command, YFeedCommandMessage)
+                  and not self.scheduler.isDue(command.feedURL, now)
+                  and (unquoteMailbox(command.mailbox) != 'INBOX'
+                       or self.scheduler.isFailing(command.feedURL))]
+        if notDue:
+            logging.info(str(len(notDue)) + " feeds are not due yet.")
+            uniqueCommands = [command for command in uniqueCommands
+                              if command not in notDue]
+
+        # Download and parse every feed before any IMAP update so that
+        # a slow host only delays its own feed.
+        feedCommands = [command for command in uniqueCommands
+                        if isinstance(command, YFeedCommandMessage)]
+        suspended = self.fetchFeeds([command.feedURL
+                                     for command in feedCommands])
+
+        # Feeds which could not be downloaded are left as they are
+        failedCommands = [command for command in feedCommands
+                          if command.feedURL not in self.feeds]
+        for command in failedCommands:
+            if command.feedURL in suspended:
+                command.suspend()
+        feedCommands = [command for command in feedCommands
+                        if command not in failedCommands]
+        uniqueCommands = [command for command in uniqueCommands
+                          if command not in failedCommands]
+
+        if IMAP_CONNECTIONS > 1:
+            # Feed mailboxes get updated in parallel, once other
+            # commands are done.
+            uniqueCommands = [command for command in uniqueCommands
+                              if command not in feedCommands]
+        result = 'OK'
         for command in uniqueCommands:
             result = command.execute(underMailbox=mailbox)
             if result is None:
                 logging.error('Could not execute command: ' + str(command))
-                break
+                return result
+        if IMAP_CONNECTIONS > 1 and feedCommands:
+            result = self.executeInParallel(feedCommands, mailbox)
 
         return result
 
 
+    def executeInParallel(self, commands, mailbox):
+        """ Executes given commands using the connections of a pool of
+        IMAP_CONNECTIONS agents. """
+
+        if self.pool is None:
+            self.pool = YAgentPool(parent=self)
+
+        def execute(command):
+            with self.pool.connection() as agent:
+                command.agent = agent
+                return command.execute(underMailbox=mailbox)
+
+        result = 'OK'
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=IMAP_CONNECTIONS) as executor:
+            futures = {executor.submit(execute, command): command
+                       for command in commands}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    commandResult = future.result()
+                except Exception:
+                    logging.error("Unexpected error:" + \
+                                  str(sys.exc_info()[1]))
+                    commandResult = None
+                if commandResult is None:
+                    logging.error('Could not execute command: ' + \
+                                  str(futures[future]))
+                    result = None
+        return result
+
+
+    def nextUpdate(self):
+        """ Returns the time of the next update of all mailboxes : when
+        the next feed is due, but no sooner than in 60 seconds and no later
+        than when every mailbox has to be searched for commands again. """
+
+        now = time.time()
+        nextPoll = self.scheduler.nextPoll()
+        if nextPoll is None:
+            nextPoll = now + COMMAND_RESCAN_INTERVAL
+        return min(max(nextPoll, now + 60), now + COMMAND_RESCAN_INTERVAL)
+
+
     def loop(self):
-        """ Main loop. """
+        """ Main loop. All mailboxes are updated when the next feed is
+        due. In between, new command messages are executed as soon as they
+        reach the INBOX if the server supports IDLE, or within 60 seconds
+        otherwise, and all mailboxes are updated right after these
+        commands created mailboxes or imported feeds. """
 
         logging.info("Agent starting loop.")
+        watcher = YIdleWatcher(parent=self)
+        if IDLE_WATCH:
+            watcher.start()
         try:
+            nextUpdate = 0
             while True:
-                self.update()
-                logging.info("Sleeping for 60 seconds.")
-                time.sleep(60)
+                watcher.arrived.clear()
+                if time.time() >= nextUpdate:
+                    self.update()
+                    nextUpdate = self.nextUpdate()
+                else:
+                    self.updateInbox()
+                    if self.treeChanged:
+                        # Mailboxes were created or filled with feed
+                        # commands, which are to be updated now
+                        nextUpdate = 0
+                logging.info("Next update in " + \
+                             str(int(nextUpdate - time.time())) + \
+                             " seconds, sleeping for 60 seconds at most.")
+                watcher.arrived.wait(min(max(nextUpdate - time.time(), 0),
+                                         60))
         except:
             logging.warning("Unexpected error:" + str(sys.exc_info()[0]))
+            watcher.stop()
+            self.renderer.close()
             self.close()
             self.logout()
             raise